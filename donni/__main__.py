@@ -1,14 +1,21 @@
 """Command-line interface setup for donni"""
 import argparse
 import pickle
+import shutil
 import sys
 import os
 import dadi
 import numpy as np
 from scipy.stats._distn_infrastructure import rv_frozen as distribution
-from donni.dadi_dem_models import get_model, get_param_values
-from donni.generate_data import generate_fs, fs_quality_check, pts_l_func
-from donni.train import prep_data, train
+from donni.dadi_dem_models import get_model, get_param_values, \
+    add_misid_values
+from donni.generate_data import generate_fs, generate_fs_shards, \
+    generate_fs_variants, fs_quality_check, pts_l_func, load_data, \
+    save_array_data, is_array_data, load_array_data, save_individual_fs, \
+    export_individual_fs, FS_OK
+from donni.calibrate_grids import calibrate_grids, save_grid_profile, \
+    load_grid_profile, DEFAULT_SCALES
+from donni.train import prep_data, train, train_stream
 from donni.infer import infer, prep_fs_for_ml, irods_download, irods_cleanup, project_fs
 from donni.validate import validate
 
@@ -26,65 +33,346 @@ def run_generate_data(args):
                 "the following arguments are required:"
                 " --outdir when using --save_individual_fs"
             )
+        if args.shard_size is not None or args.bootstrap:
+            sys.exit(
+                "donni generate_data: error: "
+                "--save_individual_fs cannot be used with --shard_size"
+                " or --bootstrap"
+            )
+    elif args.export_dadi_fs:
+        sys.exit(
+            "donni generate_data: error: "
+            "--export_dadi_fs requires --save_individual_fs"
+        )
+    if args.resume and args.seed is None:
+        sys.exit(
+            "donni generate_data: error: "
+            "--resume requires the --seed of the interrupted run"
+        )
+    if (args.extra_output or args.n_misid > 1) and (
+            args.shard_size is not None or
+            args.checkpoint_every is not None or args.resume):
+        sys.exit(
+            "donni generate_data: error: "
+            "--extra_output and --n_misid cannot be used with --shard_size,"
+            " --checkpoint_every or --resume"
+        )
+    if (args.replace_failed or args.split_grids) and (
+            args.shard_size is not None or
+            args.checkpoint_every is not None or args.resume):
+        sys.exit(
+            "donni generate_data: error: "
+            "--replace_failed and --split_grids cannot be used with"
+            " --shard_size, --checkpoint_every or --resume"
+        )
+    if args.n_misid > 1 and args.folded:
+        sys.exit(
+            "donni generate_data: error: "
+            "--n_misid cannot be used with --folded"
+        )
+    # post-processing settings of additional datasets
+    extra_outfiles = []
+    extra_variants = []
+    for extra_output in args.extra_output or []:
+        extra_outfiles.append(extra_output[0])
+        extra_variants.append(_parse_variant(extra_output[1:], args))
+    if args.data_format == "array" and (
+            args.shard_size is not None or args.bootstrap or
+            any(v["bootstrap"] for v in extra_variants)):
+        sys.exit(
+            "donni generate_data: error: "
+            "--data_format array cannot be used with --shard_size"
+            " or bootstrap data"
+        )
+    if args.store_counts and (args.data_format != "array" or
+                              args.theta == 1 or not args.no_sampling or
+                              args.save_individual_fs):
+        sys.exit(
+            "donni generate_data: error: "
+            "--store_counts requires --data_format array and sampled FS"
+            " (--theta > 1 without --no_sampling), and cannot be used"
+            " with --save_individual_fs"
+        )
+    # sampled fs stored as counts are normalized when loaded instead
+    norm = args.non_normalize and not args.store_counts
+    for variant in extra_variants:
+        if args.store_counts and variant["sampling"] and \
+                variant["theta"] != 1:
+            variant["counts"] = True
+            variant["norm_on_read"] = variant["norm"]
+            variant["norm"] = False
+    if args.n_misid > 1 and any(v["folded"] for v in extra_variants):
+        # folding cancels misid, so all misid values give the same FS
+        sys.exit(
+            "donni generate_data: error: "
+            "--n_misid cannot be used with folded --extra_output FS"
+        )
 
     # get dem function and params specifications for model
     dadi_func, param_names, logs = get_model(args.model, 
                                              args.model_file, args.folded)
+    # use the calibrated grids of the model if any
+    if args.grids is None:
+        args.grids = load_grid_profile(args.model, args.sample_sizes,
+                                       args.grid_profile_dir)
     # get demographic param values
-    params_list = get_param_values(param_names, args.n_samples, args.seed)
+    params_list = get_param_values(param_names, args.n_samples, args.seed,
+                                   args.param_sampling)
+    if args.n_misid > 1:
+        params_list = add_misid_values(params_list, args.n_misid, args.seed)
+    # grid sizes reported in the quality check
+    pts_l = args.grids or pts_l_func(args.sample_sizes)
+
+    # stream data to a dir of shards instead of one file
+    if args.shard_size is not None:
+        qual = generate_fs_shards(
+            dadi_func,
+            params_list,
+            logs,
+            args.theta,
+            args.sample_sizes,
+            args.grids,
+            args.outfile,
+            args.shard_size,
+            norm,
+            args.no_sampling,
+            args.folded,
+            args.bootstrap,
+            args.n_bstr,
+            args.n_cpu,
+            seed=args.seed,
+            resume=args.resume,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size,
+            timeout=args.sim_timeout,
+            refine_grids=args.refine_grids,
+            max_mem=args.max_mem,
+        )
+        if not args.no_fs_qual_check:
+            fs_quality_check(qual, args.outfile, params_list,
+                             param_names, logs, pts_l)
+        return
 
     # generate data
-    data, qual = generate_fs(
+    progress_dir = None
+    if args.checkpoint_every is not None or args.resume:
+        # record finished fs in a progress store next to outfile,
+        # then assemble the dataset in the order of params_list
+        progress_dir = f"{args.outfile}_progress"
+        qual = generate_fs_shards(
+            dadi_func,
+            params_list,
+            logs,
+            args.theta,
+            args.sample_sizes,
+            args.grids,
+            progress_dir,
+            args.checkpoint_every or 100,
+            norm,
+            args.no_sampling,
+            args.folded,
+            args.bootstrap,
+            args.n_bstr,
+            args.n_cpu,
+            seed=args.seed,
+            resume=args.resume,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size,
+            timeout=args.sim_timeout,
+            refine_grids=args.refine_grids,
+            max_mem=args.max_mem,
+        )
+        progress = load_data(progress_dir)
+        # failed fs are not in the progress store
+        data = {tuple(p): progress[tuple(p)] for p in params_list
+                if tuple(p) in progress}
+    else:
+        data_list, qual = _generate_fs_list(dadi_func, params_list, logs,
+                                            args, norm, extra_variants,
+                                            args.seed)
+        # replace param sets whose simulation failed or timed out with
+        # newly drawn ones, so the dataset keeps its requested size
+        new_params = params_list
+        for attempt in range(1, _MAX_REPLACE_ATTEMPTS + 1):
+            n_failed = np.count_nonzero(qual[-len(new_params):, 7] != FS_OK)
+            if not args.replace_failed or n_failed == 0:
+                break
+            seed = None if args.seed is None else [args.seed, attempt]
+            new_params = get_param_values(param_names,
+                                          -(-n_failed // args.n_misid), seed,
+                                          args.param_sampling)
+            if args.n_misid > 1:
+                new_params = add_misid_values(new_params, args.n_misid, seed)
+            new_data_list, new_qual = _generate_fs_list(
+                dadi_func, new_params, logs, args, norm, extra_variants, seed)
+            for variant_data, new_data in zip(data_list, new_data_list):
+                variant_data.update(new_data)
+            params_list = params_list + new_params
+            qual = np.concatenate([qual, new_qual])
+        data = data_list[0]
+        for outfile, variant, extra_data in zip(extra_outfiles,
+                                                extra_variants, data_list[1:]):
+            _save_data(extra_data, outfile, args, param_names, logs, variant)
+
+    # output fs quality check results
+    if not args.no_fs_qual_check:
+        fs_quality_check(qual, args.outfile, params_list, param_names, logs,
+                         pts_l)
+
+    # save data as a dictionary or as individual files
+    # (in addition to saving as a single file)
+    if args.save_individual_fs:
+        # save fs to one indexed container with the true params,
+        # index of fs matches index in true_log_params list
+        save_individual_fs(data, args.outdir)
+        if args.export_dadi_fs:
+            export_individual_fs(args.outdir)
+
+    # save data dict as one pickled file (default) or in the array format
+    _save_data(data, args.outfile, args, param_names, logs)
+
+    # progress store is no longer needed once the dataset is saved
+    if progress_dir is not None:
+        shutil.rmtree(progress_dir)
+
+
+# max number of times failed fs are replaced with --replace_failed,
+# in case the model fails in a large part of the param space
+_MAX_REPLACE_ATTEMPTS = 10
+
+
+def _generate_fs_list(dadi_func, params_list, logs, args, norm,
+                      extra_variants, seed):
+    """
+    Helper method for run_generate_data to generate the main dataset and
+    the --extra_output datasets in memory
+    Return: list of dataset dicts (main dataset first), quality check stats
+    """
+
+    if not extra_variants and args.n_misid == 1:
+        data, qual = generate_fs(
+            dadi_func,
+            params_list,
+            logs,
+            args.theta,
+            args.sample_sizes,
+            args.grids,
+            norm,
+            args.no_sampling,
+            args.folded,
+            args.bootstrap,
+            args.n_bstr,
+            args.n_cpu,
+            seed=seed,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size,
+            timeout=args.sim_timeout,
+            refine_grids=args.refine_grids,
+            split_grids=args.split_grids,
+            max_mem=args.max_mem,
+        )
+        return [data], qual
+    # post-process the same simulated fs for each output dataset
+    main_variant = {"theta": args.theta, "norm": norm,
+                    "sampling": args.no_sampling, "folded": args.folded,
+                    "bootstrap": args.bootstrap, "n_bstr": args.n_bstr}
+    return generate_fs_variants(
         dadi_func,
         params_list,
         logs,
-        args.theta,
         args.sample_sizes,
         args.grids,
-        args.non_normalize,
-        args.no_sampling,
+        [main_variant] + extra_variants,
         args.folded,
-        args.bootstrap,
-        args.n_bstr,
         args.n_cpu,
+        seed=seed,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        post_misid=args.n_misid > 1,
+        timeout=args.sim_timeout,
+        refine_grids=args.refine_grids,
+        split_grids=args.split_grids,
+        max_mem=args.max_mem,
     )
 
-    # output fs quality check results
-    if not args.no_fs_qual_check:
-        fs_quality_check(qual, args.outfile, params_list, param_names, logs)
 
-    # save data as a dictionary or as individual files
-    # (in addition to saving as a single file)
-    if args.save_individual_fs:
-        # make dir to save individual fs and true params to
-        if not os.path.exists(args.outdir):
-            os.makedirs(args.outdir)
-        # process data dict to individual fs and save
-        # index in fs file name matches index in true_log_params list
-        true_log_params = list(data.keys())
-        for i, p in enumerate(true_log_params):
-            fs = data[p]
-            fs.tofile(f"{args.outdir}/fs_{i:03d}")
-        pickle.dump(true_log_params, open(f"{args.outdir}/true_log_params", "wb"))
+def _save_data(data, outfile, args, param_names, logs, variant=None):
+    """
+    Helper method for run_generate_data to save a dataset in the
+    --data_format, with the settings of the --extra_output variant
+    (if given) recorded in the metadata of the array format
+    """
 
-    # save data dict as one pickled file (default)
-    pickle.dump(data, open(args.outfile, "wb"))
+    if args.data_format == "pickle":
+        pickle.dump(data, open(outfile, "wb"))
+        return
+    if variant is None:
+        variant = {"theta": args.theta, "norm": args.non_normalize,
+                   "sampling": args.no_sampling, "folded": args.folded,
+                   "counts": args.store_counts}
+    # folded variants of unfolded fs have no misid param
+    n_p = -1 if variant["folded"] and not args.folded else len(logs)
+    metadata = {"model": args.model, "param_names": param_names[:n_p],
+                "logs": logs[:n_p],
+                "ns": list(variant.get("ns") or args.sample_sizes),
+                "theta": variant["theta"],
+                "norm": variant.get("norm_on_read", variant["norm"]),
+                "sampling": variant["sampling"], "seed": args.seed}
+    save_array_data(data, outfile, metadata, variant.get("counts", False))
 
 
 def run_train(args):
     """Method to train MLPR given inputs from the train subcommand"""
 
-    # Load training data
-    data = pickle.load(open(args.data_file, "rb"))
-    # parse data into input and corresponding labels
-    X_input, all_y_label = prep_data(data, single_output=True)
+    if args.augment_theta is not None and \
+            args.augment_theta[0] > args.augment_theta[1]:
+        sys.exit(
+            "donni train: error: "
+            "the MIN of --augment_theta cannot be larger than its MAX"
+        )
+    if args.stream:
+        if not os.path.isdir(args.data_file):
+            sys.exit(
+                "donni train: error: "
+                "--stream requires a dataset in the array format"
+                " or a dir of shards"
+            )
+        os.makedirs(args.mlpr_dir, exist_ok=True)
+        cpu_list = train_stream(args.data_file, args.mlpr_dir, args.tune,
+                                args.shared_trunk, args.batch_size,
+                                args.shuffle_buffer, args.augment_theta,
+                                args.n_cpu)
+        _print_train_cpus(cpu_list, args.shared_trunk)
+        return
+
+    # Load training data and parse it into input and corresponding labels
+    if is_array_data(args.data_file):
+        # memory-mapped matrix of flattened fs, no need to prep_data
+        X_input, params, _, _ = load_array_data(args.data_file)
+        all_y_label = list(params.T)
+    else:
+        data = load_data(args.data_file)
+        X_input, all_y_label = prep_data(data, single_output=True)
     # make dir to save trained MLPs
     try:
         os.makedirs(args.mlpr_dir)
     except FileExistsError:
         pass
 
-    train(X_input, all_y_label, args.mlpr_dir, args.tune)
+    cpu_list = train(X_input, all_y_label, args.mlpr_dir, args.tune,
+                     args.shared_trunk, args.augment_theta, args.batch_size,
+                     args.shuffle_buffer, args.n_cpu)
+    _print_train_cpus(cpu_list, args.shared_trunk)
+
+
+def _print_train_cpus(cpu_list, shared_trunk):
+    """Helper method to report the CPUs each MLPR was trained on"""
+
+    n_cpu = len(set(cpu for cpus in cpu_list for cpu in cpus))
+    print(f"\nTrained {len(cpu_list)} MLPR(s) on {n_cpu} CPU(s):")
+    for i, cpus in enumerate(cpu_list):
+        name = "shared-trunk MLPR" if shared_trunk else f"param {i + 1:02d}"
+        print(f"{name}: {len(cpus)} CPU(s) {cpus}")
 
 
 def run_infer(args):
@@ -117,9 +405,18 @@ def run_infer(args):
     # load mlpr dir name list
     filename_list = sorted(os.listdir(args.mlpr_dir))
     
+    # grid sizes for estimating theta: the calibrated grids of the model
+    # if any, otherwise the default grids
+    pts_l = load_grid_profile(args.model, fs.sample_sizes,
+                              args.grid_profile_dir) or \
+        pts_l_func(fs.sample_sizes)
+
     # infer params using input FS
     pred, theta, cis = infer(filename_list, args.mlpr_dir, 
-                             func, fs, logs, cis=cis_list)
+                             func, fs, logs, cis=cis_list,
+                             cache_dir=args.cache_dir,
+                             cache_size=args.cache_size, pts_l=pts_l,
+                             split_grids=args.split_grids)
     
     # write output
     if args.output_prefix:
@@ -163,7 +460,6 @@ def run_infer(args):
             f"\nWARNING: Theta is not defined. Check inferred demographic model parameters for negative values."
         )
     if args.export_dadi_cli is not None:
-        pts_l = pts_l_func(fs.sample_sizes)
         fid = open(args.export_dadi_cli + ".donni.pseudofit", "w")
         fid.write("# {0}\n".format(" ".join(sys.argv)))
         fid.write(f"# grid points used: {pts_l}\n")
@@ -175,17 +471,45 @@ def run_infer(args):
         )
 
 
+def run_calibrate_grids(args):
+    """Method to calibrate the grid sizes of a model given inputs from
+    the calibrate_grids subcommand"""
+
+    dadi_func, param_names, logs = get_model(args.model, args.model_file,
+                                             args.folded)
+    params_list = get_param_values(param_names, args.n_samples, args.seed)
+    chosen, results = calibrate_grids(dadi_func, params_list, logs,
+                                      args.sample_sizes, args.folded,
+                                      args.scales, args.tolerance, args.n_cpu)
+    print(f"{'scale':>8}{'grids':>20}{'max error':>12}{'time (s)':>12}")
+    for res in results:
+        print(f"{res['scale']:>8}{str(tuple(res['pts_l'])):>20}"
+              f"{res['error']:>12.2e}{res['time']:>12.3f}")
+    print(f"\nSaving grids {tuple(chosen['pts_l'])} to the grid profile"
+          f" of {args.model}")
+    save_grid_profile(args.model, args.sample_sizes, chosen,
+                      args.grid_profile_dir)
+
+
 def run_validate(args):
-    # load test fs set
-    test_dict = pickle.load(open(args.test_dict, "rb"))
-    # prepare fs in test_dict for ml prediction:
-    # check that fs is normalized and masked entries set to 0
-    prep_test_dict = {}
-    for params_key in test_dict:
-        prep_test_dict[params_key] = prep_fs_for_ml(test_dict[params_key])
+    if is_array_data(args.test_dict):
+        # masked entries are already set to 0 in the array format
+        X_test, params, _, metadata = load_array_data(args.test_dict)
+        if not metadata["norm"]:
+            X_test = X_test / X_test.sum(axis=1, keepdims=True)
+        y_test = list(params.T)
+    else:
+        # load test fs set
+        test_dict = load_data(args.test_dict)
+        # prepare fs in test_dict for ml prediction:
+        # check that fs is normalized and masked entries set to 0
+        prep_test_dict = {}
+        for params_key in test_dict:
+            prep_test_dict[params_key] = prep_fs_for_ml(
+                test_dict[params_key])
 
-    # parse test dict into test FS and corresponding labels
-    X_test, y_test = prep_data(prep_test_dict, single_output=True)
+        # parse test dict into test FS and corresponding labels
+        X_test, y_test = prep_data(prep_test_dict, single_output=True)
 
     # load mvenn dir name list
     filename_list = sorted(os.listdir(args.mlpr_dir))
@@ -220,6 +544,104 @@ def _pos_int(input_int):
     return int(input_int)
 
 
+def _pos_float(input_float):
+    """
+    Check positive float
+    """
+
+    if float(input_float) <= 0:
+        raise argparse.ArgumentTypeError(
+            f"{input_float} is not a positive float")
+    return float(input_float)
+
+
+def _parse_variant(settings, args):
+    """
+    Parse the KEY=VALUE post-processing settings of an --extra_output
+    dataset. Settings not given are the same as the main output.
+    """
+
+    variant = {"theta": args.theta, "norm": args.non_normalize,
+               "sampling": args.no_sampling, "folded": args.folded,
+               "bootstrap": args.bootstrap, "n_bstr": args.n_bstr}
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        if key == "sample_sizes":
+            # projected from the simulated --sample_sizes
+            variant["ns"] = [_pos_int(n) for n in value.split(",")]
+            if len(variant["ns"]) != len(args.sample_sizes) or any(
+                    v_n > n for v_n, n in zip(variant["ns"],
+                                              args.sample_sizes)):
+                sys.exit(
+                    "donni generate_data: error: --extra_output "
+                    "sample_sizes must be no larger than --sample_sizes"
+                )
+            continue
+        if key not in variant:
+            sys.exit(
+                "donni generate_data: error: "
+                f"unknown --extra_output setting: {key}"
+            )
+        if key in ["theta", "n_bstr"]:
+            variant[key] = _pos_int(value)
+        elif value.lower() in ["true", "false"]:
+            variant[key] = value.lower() == "true"
+        else:
+            sys.exit(
+                "donni generate_data: error: "
+                f"--extra_output setting {key} must be true or false"
+            )
+    if variant["folded"] is False and args.folded:
+        sys.exit(
+            "donni generate_data: error: "
+            "cannot make unfolded --extra_output FS with --folded"
+        )
+    if variant["bootstrap"] and variant["theta"] == 1:
+        sys.exit(
+            "donni generate_data: error: "
+            "cannot bootstrap --extra_output FS with theta=1"
+        )
+    return variant
+
+
+def _add_cache_arguments(subparser):
+    """
+    Add the simulated FS cache arguments shared by several subcommands
+    """
+
+    subparser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Dir of an on-disk cache of simulated FS, reused across runs\
+                                when the same model, params, sample sizes\
+                                and grids are simulated again (default no\
+                                caching)",
+    )
+    subparser.add_argument(
+        "--cache_size",
+        type=_pos_int,
+        default=10000,
+        help="Max size of the simulated FS cache in MB; the least recently\
+                                used FS are evicted beyond it",
+    )
+
+
+def _add_grid_profile_argument(subparser):
+    """
+    Add the grid profile argument shared by several subcommands
+    """
+
+    subparser.add_argument(
+        "--grid_profile_dir",
+        type=str,
+        default=None,
+        help="Dir of the per-model grid profiles written by donni\
+                                calibrate_grids (default in the user data\
+                                dir of donni)",
+    )
+
+
 def donni_parser():
     """Get command-line arguments"""
 
@@ -270,6 +692,23 @@ def donni_parser():
         help="Path to save generated data and\
                                          associated quality check file",
     )
+    generate_data_parser.add_argument(
+        "--data_format",
+        choices=["pickle", "array"],
+        default="pickle",
+        help="Save data as a pickled dictionary of FS, or in the array\
+                                        format: a dir with the FS and params\
+                                        as .npy matrices that donni train and\
+                                        validate memory-map",
+    )
+    generate_data_parser.add_argument(
+        "--store_counts",
+        action="store_true",
+        help="With --data_format array, store sampled FS as uint16 or\
+                                        uint32 counts with their totals,\
+                                        normalized when loaded for training\
+                                        or validation",
+    )
     generate_data_parser.add_argument(
         "--save_individual_fs",
         action="store_true",
@@ -279,6 +718,65 @@ def donni_parser():
     generate_data_parser.add_argument(
         "--outdir", type=str, help="Dir to save individual FS"
     )
+    generate_data_parser.add_argument(
+        "--export_dadi_fs",
+        action="store_true",
+        help="With --save_individual_fs, also write each FS as a dadi\
+                                        FS file (fs_000, fs_001, ...) in\
+                                        --outdir",
+    )
+    generate_data_parser.add_argument(
+        "--shard_size",
+        type=_pos_int,
+        help="Stream FS to disk as they are simulated: --outfile becomes\
+                                        a dir of pickled shards, each holding\
+                                        at most this many FS",
+        default=None,
+    )
+    generate_data_parser.add_argument(
+        "--n_misid",
+        type=_pos_int,
+        default=1,
+        help="For unfolded FS, number of misid values per simulated FS:\
+                                        misid is applied after simulation, so\
+                                        the dataset has n_samples * n_misid\
+                                        FS for the cost of n_samples\
+                                        simulations",
+    )
+    generate_data_parser.add_argument(
+        "--extra_output",
+        nargs="+",
+        action="append",
+        metavar=("OUTFILE", "KEY=VALUE"),
+        help="Save an additional dataset post-processed from the same\
+                                        simulated FS, e.g. --extra_output\
+                                        data/test theta=1000. Settings are\
+                                        theta, n_bstr, norm, sampling, folded\
+                                        and bootstrap (true/false), and\
+                                        sample_sizes (e.g. 10,10) to project\
+                                        the FS down to smaller sample sizes;\
+                                        settings not given are the same as\
+                                        the main output. Can be used multiple\
+                                        times",
+    )
+    generate_data_parser.add_argument(
+        "--checkpoint_every",
+        type=_pos_int,
+        help="Record finished FS in a progress store ({outfile}_progress)\
+                                        every this many FS, so that an\
+                                        interrupted run can be continued\
+                                        with --resume (default 100 with\
+                                        --resume)",
+        default=None,
+    )
+    generate_data_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from its progress store (or\
+                                        from its shards with --shard_size),\
+                                        simulating only the missing FS.\
+                                        Requires the same --seed and settings",
+    )
     generate_data_parser.add_argument(
         "--grids", type=_pos_int, nargs=3, help="Sizes of grids", default=None
     )
@@ -288,6 +786,15 @@ def donni_parser():
     generate_data_parser.add_argument(
         "--seed", type=_pos_int, help="Seed for reproducibility"
     )
+    generate_data_parser.add_argument(
+        "--param_sampling",
+        choices=["random", "sobol", "lhs"],
+        default="random",
+        help="How to sample the demographic param values: independent\
+                                        random draws, or quasi-random Sobol\
+                                        or Latin hypercube designs that cover\
+                                        the param ranges more evenly",
+    )
     generate_data_parser.add_argument(
         "--non_normalize", action="store_false", help="Don't normalize FS"
     )
@@ -313,11 +820,58 @@ def donni_parser():
     generate_data_parser.add_argument(
         "--n_cpu", type=_pos_int, help="Number of CPUs to use"
     )
+    generate_data_parser.add_argument(
+        "--sim_timeout",
+        type=_pos_float,
+        default=None,
+        help="Wall-clock time limit in seconds for simulating each FS:\
+                                        FS whose simulation runs longer or\
+                                        fails are left out of the dataset\
+                                        and listed in the quality check\
+                                        (default no limit)",
+    )
+    generate_data_parser.add_argument(
+        "--replace_failed",
+        action="store_true",
+        help="Replace FS whose simulation failed or timed out with FS\
+                                        from newly drawn params, so the\
+                                        dataset keeps its requested size",
+    )
+    generate_data_parser.add_argument(
+        "--refine_grids",
+        type=_pos_int,
+        default=2,
+        help="Max number of times an FS with negative entries above 0.1%%\
+                                        of its sum is re-simulated on 1.5\
+                                        times larger grids (0 to turn off),\
+                                        so only those FS pay for larger\
+                                        grids",
+    )
+    generate_data_parser.add_argument(
+        "--split_grids",
+        action="store_true",
+        help="Simulate each FS on each of its three grids as a separate\
+                                        task, so a few expensive FS (e.g.\
+                                        small --n_samples of 3D models) use\
+                                        more CPUs",
+    )
+    generate_data_parser.add_argument(
+        "--max_mem",
+        type=_pos_int,
+        default=None,
+        help="Memory budget in MB for simulating FS: fewer than --n_cpu\
+                                        CPUs are used if the estimated\
+                                        memory of each simulation (large for\
+                                        3D models) does not fit in it\
+                                        (default no limit)",
+    )
     generate_data_parser.add_argument(
         "--no_fs_qual_check",
         action="store_true",
         help="Turn off default FS quality check",
     )
+    _add_cache_arguments(generate_data_parser)
+    _add_grid_profile_argument(generate_data_parser)
 
     # subcommand for train
     train_parser = subparsers.add_parser(
@@ -336,6 +890,32 @@ def donni_parser():
     train_parser.add_argument("--tune", action='store_true',
                             help="Whether to try a range of hyperparameters\
                                 to find the best performing MLPRs")   
+    train_parser.add_argument("--shared_trunk", action='store_true',
+                            help="Train a single MLPR for all params, with\
+                                a first hidden layer shared by one head per\
+                                param, instead of one MLPR per param")
+    train_parser.add_argument("--stream", action='store_true',
+                            help="Stream the training data from disk\
+                                instead of loading it into memory, for\
+                                datasets in the array format or as shards\
+                                that are larger than memory")
+    train_parser.add_argument("--n_cpu", type=_pos_int,
+                            help="Number of CPUs to split between the MLPRs\
+                                trained at once (default: all available)")
+    train_parser.add_argument("--augment_theta", type=_pos_float, nargs=2,
+                            metavar=("MIN", "MAX"),
+                            help="Replace the training FS by new Poisson\
+                                samples every epoch, with theta drawn\
+                                log-uniformly between MIN and MAX for each\
+                                FS, and normalize them")
+    train_parser.add_argument("--batch_size", type=_pos_int, default=32,
+                            help="With --stream or --augment_theta, number\
+                                of FS in each training batch")
+    train_parser.add_argument("--shuffle_buffer", type=_pos_int,
+                            default=10000,
+                            help="With --stream or --augment_theta, number\
+                                of FS in the buffer the training FS are\
+                                shuffled in")
     
     # subcommand for infer
     infer_parser = subparsers.add_parser(
@@ -412,6 +992,68 @@ def donni_parser():
         default=None,
         help="Optional. Pass in a specific version of MLPR models to download through iRODS. Default will be the latest version.",
     )
+    infer_parser.add_argument(
+        "--split_grids",
+        action="store_true",
+        help="Simulate the FS for estimating theta on its three grids in\
+                        parallel",
+    )
+    _add_cache_arguments(infer_parser)
+    _add_grid_profile_argument(infer_parser)
+
+    # subcommand for calibrate_grids
+    calibrate_parser = subparsers.add_parser(
+        "calibrate_grids",
+        help="Find the cheapest grid sizes of a model that simulate\
+                        accurate enough FS",
+    )
+    calibrate_parser.set_defaults(func=run_calibrate_grids)
+    calibrate_parser.add_argument(
+        "--model", type=str, required=True, help="Name of dadi demographic model"
+    )
+    calibrate_parser.add_argument(
+        "--model_file",
+        type=str,
+        help="Name of file containing custom dadi\
+                                 demographic model(s)",
+    )
+    calibrate_parser.add_argument(
+        "--sample_sizes",
+        type=_pos_int,
+        nargs="+",
+        required=True,
+        help="Sample sizes of populations",
+    )
+    calibrate_parser.add_argument(
+        "--n_samples",
+        type=_pos_int,
+        default=20,
+        help="Number of pilot param sets to simulate",
+    )
+    calibrate_parser.add_argument(
+        "--seed", type=_pos_int, help="Seed for reproducibility"
+    )
+    calibrate_parser.add_argument(
+        "--scales",
+        type=_pos_float,
+        nargs="+",
+        default=list(DEFAULT_SCALES),
+        help="Scales of the default grid sizes to try",
+    )
+    calibrate_parser.add_argument(
+        "--tolerance",
+        type=_pos_float,
+        default=0.01,
+        help="Max error of the pilot FS, relative to the sum of the FS\
+                                simulated on grids twice the default size",
+    )
+    calibrate_parser.add_argument(
+        "--folded", action="store_true", help="Whether the FS are folded"
+    )
+    calibrate_parser.add_argument(
+        "--n_cpu", type=_pos_int, help="Number of CPUs to use"
+    )
+    _add_grid_profile_argument(calibrate_parser)
 
     # subcommand for validate
     validate_parser = subparsers.add_parser(
@@ -0,0 +1,143 @@
+'''
+Module for calibrating the dadi grid sizes of a demographic model:
+a pilot sample of param sets is simulated on grids of several scales,
+and the cheapest grids whose fs are close enough to those of much
+larger grids are saved to a per-model grid profile
+'''
+import os
+import json
+import time
+import warnings
+from multiprocessing import Pool
+import numpy as np
+from appdirs import AppDirs
+from donni.generate_data import pts_l_func, simulate_fs, _chunksize
+
+# scales of the default grid sizes tried by calibrate_grids()
+DEFAULT_SCALES = (0.5, 0.75, 1, 1.25, 1.5)
+# scale of the grids of the reference fs that the errors are measured to
+REFERENCE_SCALE = 2
+
+
+def scale_pts_l(ns, scale):
+    '''
+    Grid sizes of pts_l_func(ns) multiplied by scale
+    '''
+    return tuple(int(pts * scale) for pts in pts_l_func(ns))
+
+
+def _timed_simulation(args):
+    '''
+    Helper function for calibrate_grids() to simulate one fs in a worker
+    Return: fs with masked entries set to zero, and simulation time in
+        seconds
+    '''
+    p, func, ns, pts_l, folded = args
+    start = time.perf_counter()
+    fs = simulate_fs(p, func, ns, pts_l, folded)
+    return np.ma.filled(fs, 0), time.perf_counter() - start
+
+
+def calibrate_grids(func, params_list, logs, ns, folded=False,
+                    scales=DEFAULT_SCALES, tolerance=0.01, ncpu=None):
+    '''
+    Find the cheapest grid sizes of a model for the sample sizes ns.
+    The error of a fs is the sum of its absolute difference to the fs
+    simulated on REFERENCE_SCALE times the default grids, relative to the
+    sum of the reference fs.
+    Inputs:
+        func: dadi demographic model
+        params_list: pilot param sets, e.g. from get_param_values()
+        logs: indicate which dem param is in log10 values
+        ns: population sample size(s)
+        folded: whether the model is simulated without the misid wrapper
+        scales: scales of the default grid sizes (from pts_l_func()) to try
+        tolerance: max error of the pilot fs
+        ncpu: number of CPUs to use (None means all)
+    Output: the chosen scale, and list of dicts with keys scale, pts_l,
+        error (max over the pilot fs) and time (mean simulation time in
+        seconds) for each scale. The chosen scale is the fastest one
+        meeting the tolerance, or the most accurate one if none does.
+    '''
+    delog_list = [[10**p[i] if logs[i] else p[i] for i in range(len(logs))]
+                  for p in params_list]
+    results = []
+    with Pool(processes=ncpu) as pool:
+        def simulate(pts_l):
+            arg_list = [(p, func, ns, pts_l, folded) for p in delog_list]
+            return pool.map(_timed_simulation, arg_list,
+                            _chunksize(len(arg_list), ncpu))
+
+        ref_list = [fs for fs, _ in
+                    simulate(scale_pts_l(ns, REFERENCE_SCALE))]
+        for scale in scales:
+            pts_l = scale_pts_l(ns, scale)
+            sim_list = simulate(pts_l)
+            error = max(np.abs(fs - ref).sum() / np.abs(ref).sum()
+                        for (fs, _), ref in zip(sim_list, ref_list))
+            results.append({"scale": scale, "pts_l": list(pts_l),
+                            "error": float(error),
+                            "time": float(np.mean([t for _, t in sim_list]))})
+
+    passed = [res for res in results if res["error"] <= tolerance]
+    if passed:
+        return min(passed, key=lambda res: res["time"]), results
+    warnings.warn(f"No grid scale has an error below {tolerance}, "
+                  "using the most accurate one")
+    return min(results, key=lambda res: res["error"]), results
+
+
+def default_profile_dir():
+    '''
+    Default dir of the grid profiles, in the user data dir of donni
+    '''
+    return os.path.join(AppDirs("donni", "Linh Tran").user_data_dir,
+                        "grid_profiles")
+
+
+def _profile_file(model_name, profile_dir):
+    '''
+    Helper function to get the grid profile file of a model
+    '''
+    if profile_dir is None:
+        profile_dir = default_profile_dir()
+    return os.path.join(profile_dir, f"{model_name}.json")
+
+
+def _read_profile(fname):
+    '''
+    Helper function to read a grid profile file (empty if missing)
+    '''
+    try:
+        with open(fname) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def save_grid_profile(model_name, ns, calibration, profile_dir=None):
+    '''
+    Save the calibrated grids of a model for the sample sizes ns to the
+    grid profile of the model, keeping those of other sample sizes
+    calibration: dict from calibrate_grids(), with the pts_l key
+    '''
+    fname = _profile_file(model_name, profile_dir)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    profile = _read_profile(fname)
+    profile["_".join(str(n) for n in ns)] = calibration
+    # write to a temporary file first since other processes may read it
+    with open(f"{fname}.tmp", "w") as fh:
+        json.dump(profile, fh, indent=2)
+    os.replace(f"{fname}.tmp", fname)
+
+
+def load_grid_profile(model_name, ns, profile_dir=None):
+    '''
+    Get the calibrated grid sizes of a model for the sample sizes ns
+    Return: tuple of grid sizes, or None if not calibrated
+    '''
+    calibration = _read_profile(_profile_file(model_name, profile_dir)).get(
+        "_".join(str(n) for n in ns))
+    if calibration is None:
+        return None
+    return tuple(calibration["pts_l"])
@@ -3,8 +3,10 @@ parameter range values"""
 import sys
 import os
 import importlib
+import warnings
 from inspect import getmembers, isfunction
 import numpy as np
+from scipy.stats import qmc
 import dadi
 import donni.portik_models.portik_models_2d
 import donni.portik_models.portik_models_3d
@@ -88,43 +90,101 @@ def get_model(model_name, model_file=None, folded=False):
     return func, param_names, logs
 
 
-def get_param_values(param_names, n_samples, seed=None):
+def get_param_values(param_names, n_samples, seed=None, method="random"):
     """
     Generate a list of randomly selected demographic parameter values.
     Input:
         param_names list: List of demographic parameter names.
         n_samples int: number of unique param sets
         seed int: seed value to generate the same set of param values
-        seed_offset int: offset the seed selection range to ensure
-            different seeds selected for generating training vs. test data
+        method str: how to sample the param values, see
+            sample_param_values()
     Output:
         params_list list: List of length n_samples of parameter values.
     """
-    # set random seed
-    np.random.seed(seed)
-    # generate param values
-    params_list = []
-    for _ in range(n_samples):
-        p = []
-        # special handling for T param with Tsum restriction
-        n_T = sum([name.startswith("T") for name in param_names])
-        T_fraction_list = np.random.dirichlet(np.ones(n_T))
-        T_fraction_index = 0
-        t_sum = _param_range("T")
-        for name in param_names:
-            if name.startswith("T"):
-                p_val = t_sum * T_fraction_list[T_fraction_index]
-                T_fraction_index += 1
-            elif name.startswith("nu"):
-                p_val = _param_range("nu")
-            elif name == "misid":
-                p_val = _param_range("misid")
-            else:
-                p_val = _param_range(name[0])
-            p.append(p_val)
-        params_list.append(tuple(p))
-
-    return params_list
+    values = sample_param_values(param_names, n_samples, seed, method)
+    return [tuple(p) for p in values.tolist()]
+
+
+def sample_param_values(param_names, n_samples, seed=None, method="random"):
+    """
+    Vectorized sampling of demographic parameter values.
+    Input:
+        param_names list: List of demographic parameter names.
+        n_samples int: number of param sets
+        seed int: seed value to generate the same set of param values
+        method str: "random" for independent uniform draws, or "sobol"
+            or "lhs" for quasi-random Sobol or Latin hypercube designs,
+            which cover the param ranges more evenly with fewer samples
+    Output:
+        values array: array of shape (n_samples, len(param_names))
+    """
+    rng = np.random.default_rng(seed)
+    n_params = len(param_names)
+    # one uniform [0, 1) dimension per param: for the T params with
+    # Tsum restriction, one dimension for Tsum and the others for
+    # the fraction of Tsum of each T param but the last
+    if method == "random":
+        unit = rng.random((n_samples, n_params))
+    elif method in ["sobol", "lhs"]:
+        if method == "sobol":
+            sampler = qmc.Sobol(n_params, seed=rng)
+        else:
+            sampler = qmc.LatinHypercube(n_params, seed=rng)
+        with warnings.catch_warnings():
+            # Sobol points are only balanced for powers of 2 samples
+            warnings.simplefilter("ignore", UserWarning)
+            unit = sampler.random(n_samples)
+    else:
+        raise ValueError(f"Unknown param sampling method: {method}")
+
+    values = np.empty((n_samples, n_params))
+    T_idx = [i for i, name in enumerate(param_names) if name.startswith("T")]
+    if len(T_idx) != 0:
+        t_sum = _scale_param("T", unit[:, T_idx[0]])
+        # uniform fractions of Tsum (flat Dirichlet) by stick-breaking:
+        # the k-th fraction of what is left is Beta(1, n_T - 1 - k)
+        left = np.ones(n_samples)
+        for k, i in enumerate(T_idx[:-1]):
+            n_left = len(T_idx) - 1 - k
+            frac = left * (1 - (1 - unit[:, T_idx[k + 1]])**(1 / n_left))
+            values[:, i] = t_sum * frac
+            left -= frac
+        values[:, T_idx[-1]] = t_sum * left
+    for i, name in enumerate(param_names):
+        if name.startswith("T"):
+            continue
+        if name.startswith("nu"):
+            param_type = "nu"
+        elif name == "misid":
+            param_type = "misid"
+        else:
+            param_type = name[0]
+        values[:, i] = _scale_param(param_type, unit[:, i])
+    return values
+
+
+def add_misid_values(params_list, n_misid, seed=None):
+    """
+    Augment param sets of unfolded FS with additional misid values.
+    Input:
+        params_list list: param sets from get_param_values(), with the
+            misid param last
+        n_misid int: number of misid values per param set, including
+            the original one
+        seed int: seed value to generate the same misid values
+    Output:
+        params_list list: List of length n_misid * len(params_list), where
+            each param set is followed by n_misid - 1 copies of itself
+            with new random misid values
+    """
+    rng = np.random.default_rng(seed)
+    aug_params_list = []
+    for p in params_list:
+        aug_params_list.append(tuple(p))
+        for misid in _param_range("misid", rng, n_misid - 1):
+            aug_params_list.append(tuple(p[:-1]) + (float(misid),))
+    return aug_params_list
 
 
 def print_built_in_models():
@@ -143,16 +203,28 @@ def print_built_in_models():
     print()
 
 
-def _param_range(param_type):
+# biologically realistic range for each type of dem param:
+# values are drawn as (uniform[0, 1) * a + b) / c for (a, b, c)
+_range_dict = {"nu": (4, -2, 1),
+               "T": (1.99, 0.01, 1),
+               "m": (10, 0, 1),
+               "s": (0.98, 0.01, 1),
+               "F": (1, 0, 1),
+               "f": (1, 0, 1),
+               "misid": (1, 0, 4)}
+
+
+def _param_range(param_type, rng=np.random, size=None):
     ''' Helper function to generate random parameter values
     within biologically realistic range for each type of dem param.
-    Input: param_type is a string corresponding to range_dict key'''
-    range_dict = {"nu": (4, -2, 1),
-                  "T": (1.99, 0.01, 1),
-                  "m": (10, 0, 1),
-                  "s": (0.98, 0.01, 1),
-                  "F": (1, 0, 1),
-                  "f": (1, 0, 1),
-                  "misid": (1, 0, 4)}
-    a, b, c = range_dict[param_type]
-    return (np.random.random() * a + b) / c
+    Input: param_type is a string corresponding to _range_dict key,
+        rng is the random generator (default global numpy random state),
+        size is the number of values (default a single value)'''
+    return _scale_param(param_type, rng.random(size))
+
+
+def _scale_param(param_type, unit):
+    ''' Helper function to scale uniform [0, 1) values to the
+    biologically realistic range of param_type (a _range_dict key)'''
+    a, b, c = _range_dict[param_type]
+    return (unit * a + b) / c
@@ -0,0 +1,140 @@
+'''
+Module for an on-disk cache of dadi-simulated fs, shared between runs
+'''
+import os
+import time
+import pickle
+import hashlib
+import inspect
+from importlib import metadata
+import numpy as np
+
+# number of cache writes between two scans of the cache size
+_EVICT_EVERY = 100
+_writes_since_evict = 0
+# suffix of cache entries, only files with it are ever evicted
+_SUFFIX = '.fs.pkl'
+# age in seconds after which a temporary file is left from a killed process
+_TMP_MAX_AGE = 3600
+
+
+def _cache_path(cache_dir, key):
+    '''
+    Helper function to get the file of a cache entry
+    '''
+    return os.path.join(cache_dir, f'{key}{_SUFFIX}')
+
+
+def fs_cache_key(func, p, ns, pts_l, folded):
+    '''
+    Content-addressed cache key of a simulated fs
+    Inputs:
+        func: dadi demographic model (before misid/extrap wrapping)
+        p: demographic param values (de-logged, including misid if unfolded)
+        ns: population sample size(s)
+        pts_l: dadi extrapolation grid values
+        folded: whether the model is used without the misid wrapper
+    Output: hex digest hashing the model name, the source code of the
+        module defining the model, dadi version, param values, sample sizes, grid sizes and misid wrapping
+    '''
+    # hash the source of the whole module defining the model, so that
+    # edits to helper functions it calls also invalidate the cache
+    try:
+        source = inspect.getsource(inspect.getmodule(func))
+    except (OSError, TypeError):
+        source = ''
+    try:
+        dadi_version = metadata.version('dadi')
+    except metadata.PackageNotFoundError:
+        dadi_version = ''
+    h = hashlib.sha256()
+    h.update(f'{func.__module__}.{func.__qualname__}'.encode())
+    h.update(source.encode())
+    h.update(dadi_version.encode())
+    h.update(np.asarray(p, dtype=np.float64).tobytes())
+    h.update(np.asarray(ns, dtype=np.int64).tobytes())
+    h.update(np.asarray(pts_l, dtype=np.int64).tobytes())
+    h.update(b'folded' if folded else b'misid')
+    return h.hexdigest()
+
+
+def load_cached_fs(cache_dir, key):
+    '''
+    Get a simulated fs from the cache
+    Return: the cached fs, or None if not in the cache
+    '''
+    fname = _cache_path(cache_dir, key)
+    try:
+        with open(fname, 'rb') as fh:
+            fs = pickle.load(fh)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        # missing, or being evicted/written by another process
+        return None
+    # mark as recently used for LRU eviction
+    try:
+        os.utime(fname)
+    except OSError:
+        # evicted by another process since it was read
+        pass
+    return fs
+
+
+def save_cached_fs(cache_dir, key, fs, max_size):
+    '''
+    Add a simulated fs to the cache, then evict the least recently used
+    fs if the cache is larger than max_size (in MB)
+    '''
+    global _writes_since_evict
+    os.makedirs(cache_dir, exist_ok=True)
+    fname = _cache_path(cache_dir, key)
+    # write to a temporary file first since other processes may read it
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as fh:
+        pickle.dump(fs, fh)
+    os.replace(tmp_fname, fname)
+
+    # scanning the whole cache on every write is slow for large caches
+    _writes_since_evict += 1
+    if _writes_since_evict >= _EVICT_EVERY:
+        _writes_since_evict = 0
+        evict_fs_cache(cache_dir, max_size)
+
+
+def evict_fs_cache(cache_dir, max_size):
+    '''
+    Remove the least recently used fs until the cache is no larger
+    than 90% of max_size (in MB), to avoid evicting on every write.
+    Temporary files left by killed processes are also removed.
+    Other files in cache_dir are never touched.
+    '''
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    now = time.time()
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith(_SUFFIX):
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        elif _SUFFIX in entry.name and entry.name.endswith('.tmp') \
+                and now - stat.st_mtime > _TMP_MAX_AGE:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    total = sum(size for _, size, _ in entries)
+    if total <= max_size * 2**20:
+        return
+    target = 0.9 * max_size * 2**20
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
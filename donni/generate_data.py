@@ -1,28 +1,530 @@
 '''
 Method for generating dadi-simulated fs datasets
 '''
+import os
 import sys
+import json
+import pickle
+import signal
+import tempfile
+import time
 from multiprocessing import Pool
 import numpy as np
 import dadi
+from donni.fs_cache import fs_cache_key, load_cached_fs, save_cached_fs, \
+    evict_fs_cache
 
 
-def worker_func(args: tuple):
+def _make_func_ex(func, folded):
     '''
-    Helper function for generate_fs() to perform parallelization with Pool
-    Return: a single fs
+    Helper function to wrap a dadi demographic model with misid (if not
+    folded) and extrapolation
+    Return: extrapolated model function
     '''
-
-    (p, func, ns, pts_l, folded) = args
     if not folded:
         func = dadi.Numerics.make_anc_state_misid_func(func)
-    func_ex = dadi.Numerics.make_extrap_func(func)
-    return func_ex(p, ns, pts_l)
+    return dadi.Numerics.make_extrap_func(func)
+
+
+def simulate_fs(p, func, ns, pts_l, folded, cache_dir=None, cache_size=10000,
+                func_ex=None):
+    '''
+    Simulate a single fs with dadi, reusing a previously simulated fs
+    from the on-disk cache if cache_dir is given
+    Inputs:
+        p: demographic param values (de-logged, including misid if unfolded)
+        func: dadi demographic model
+        ns: population sample size(s)
+        pts_l: dadi extrapolation grid values
+        folded: whether to skip the misid wrapper of the model
+        cache_dir: dir of the fs cache (None means no caching)
+        cache_size: max size of the fs cache in MB
+        func_ex: func already wrapped by _make_func_ex() (None means
+            wrapping func for this simulation)
+    Return: a single fs
+    '''
+    if cache_dir is not None:
+        key = fs_cache_key(func, p, ns, pts_l, folded)
+        fs = load_cached_fs(cache_dir, key)
+        if fs is not None:
+            return fs
+    if func_ex is None:
+        func_ex = _make_func_ex(func, folded)
+    fs = func_ex(p, ns, pts_l)
+    if cache_dir is not None:
+        save_cached_fs(cache_dir, key, fs, cache_size)
+    return fs
+
+
+# fraction of the sum of a fs in negative entries above which the fs is
+# reported by fs_quality_check() and re-simulated on larger grids
+NEG_FS_THRESHOLD = 0.001
+# factor by which the grid sizes grow with each grid refinement
+GRID_REFINE_FACTOR = 1.5
+
+
+def refine_pts_l(pts_l, level):
+    '''
+    Grid sizes after level refinements of the grid sizes pts_l
+    '''
+    return tuple(int(pts * GRID_REFINE_FACTOR**level) for pts in pts_l)
+
+
+def _neg_fraction(fs):
+    '''
+    Helper function to get the fraction of the sum of a simulated fs
+    in negative entries (same as the last stat of _check_fs())
+    '''
+    arr = np.ma.filled(fs, 0)
+    neg = arr < 0
+    if not neg.any():
+        return 0
+    return abs(arr[neg].sum() / arr.sum())
+
+
+# settings shared by all tasks of a pool worker, set by _init_worker()
+_worker_state = {}
+
+# status of each fs, stored in column 7 of the quality check stats
+FS_OK = 0
+FS_FAILED = 1
+FS_TIMED_OUT = 2
+
+
+def _init_worker(func, ns, pts_l, folded, cache_dir, cache_size, timeout,
+                 refine_grids, post_args):
+    '''
+    Pool initializer for generate_fs_variants() and generate_fs_shards():
+    the model (sent by reference, i.e. resolved from its module in the
+    worker) is wrapped once per worker instead of once per task, and the
+    settings shared by all tasks are not pickled into every task
+    timeout: wall-clock time limit in seconds of each fs (None means
+        no limit), see _worker_run()
+    refine_grids: max number of grid refinements of each fs, see
+        _worker_simulate_refined_fs()
+    '''
+    _worker_state["sim_args"] = (func, ns, pts_l, folded, cache_dir,
+                                 cache_size, _make_func_ex(func, folded))
+    # model for a single grid size, for split_grids
+    _worker_state["grid_func"] = func if folded else \
+        dadi.Numerics.make_anc_state_misid_func(func)
+    _worker_state["post_args"] = post_args
+    _worker_state["timeout"] = timeout
+    _worker_state["refine_grids"] = refine_grids
+    if timeout is not None:
+        signal.signal(signal.SIGALRM, _timeout_handler)
+
+
+def _timeout_handler(signum, frame):
+    '''
+    Signal handler interrupting a simulation that exceeds its timeout
+    '''
+    raise TimeoutError
+
+
+def _worker_run(process, *args):
+    '''
+    Helper function to simulate and post-process one fs with
+    process(*args) in a worker, so that one bad param set (raising an
+    error, or running for longer than the timeout of the worker) does
+    not stop or stall the whole run
+    Return: output of process (None if failed), and status of the fs
+    '''
+    timeout = _worker_state["timeout"]
+    try:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return process(*args), FS_OK
+        finally:
+            if timeout is not None:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    except TimeoutError:
+        return None, FS_TIMED_OUT
+    except Exception:
+        return None, FS_FAILED
+
+
+def _init_variants_worker(sim_args, post_args, out_list):
+    '''
+    Pool initializer for generate_fs_variants(): same as _init_worker(),
+    and maps the output matrix of each variant written by the workers
+    (None for variants whose fs are sent back to the main process)
+    '''
+    _init_worker(*sim_args, post_args)
+    _worker_state["out"] = [
+        None if out is None else
+        np.memmap(out[0], dtype=np.float64, mode="r+", shape=out[1])
+        for out in out_list]
+
+
+def _worker_simulate_fs(p, level=0):
+    '''
+    Helper function to simulate one fs in a worker set up by _init_worker()
+    level: number of refinements of the grid sizes of the worker
+    Return: a single fs
+    '''
+    func, ns, pts_l, folded, cache_dir, cache_size, func_ex = \
+        _worker_state["sim_args"]
+    return simulate_fs(p, func, ns, refine_pts_l(pts_l, level), folded,
+                       cache_dir, cache_size, func_ex)
+
+
+def _worker_simulate_refined_fs(p):
+    '''
+    Helper function to simulate one fs in a worker, re-simulating it on
+    progressively larger grids (up to the refine_grids of the worker)
+    while its negative entries exceed NEG_FS_THRESHOLD of its sum, so
+    only the fs failing the quality check pay for larger grids
+    Return: a single fs, and number of grid refinements used
+    '''
+    sim_fs = _worker_simulate_fs(p)
+    level = 0
+    while level < _worker_state["refine_grids"] and \
+            _neg_fraction(sim_fs) > NEG_FS_THRESHOLD:
+        level += 1
+        sim_fs = _worker_simulate_fs(p, level)
+    return sim_fs, level
+
+
+def _grid_worker_func(args):
+    '''
+    Helper function for _simulate_split_grids() to simulate one fs on a
+    single grid size (without extrapolation) in a worker
+    Return: index of the param set and of the grid size, fs (None if
+        failed) and status of the fs
+    '''
+    sim_idx, grid_idx, p, pts = args
+    ns = _worker_state["sim_args"][1]
+    fs, status = _worker_run(_worker_state["grid_func"], p, ns, pts)
+    return sim_idx, grid_idx, fs, status
+
+
+def _extrapolate(result_l, pts_l):
+    '''
+    Helper function to extrapolate fs simulated on each grid size of
+    pts_l, with the same extrapolation as dadi.Numerics.make_extrap_func()
+    '''
+    lookup = dict(zip(pts_l, result_l))
+    return dadi.Numerics.make_extrap_func(lambda pts: lookup[pts])(pts_l)
+
+
+def _simulate_split_grids(pool, p_list, func, ns, pts_l, folded, cache_dir,
+                          cache_size, refine_grids):
+    '''
+    Helper function to simulate each param set of p_list on each grid
+    size of pts_l as a separate task of the pool (set up by
+    _init_worker()), extrapolating in this process once the fs of all
+    grid sizes of a param set are in. The largest grids, which dominate
+    the simulation time, are sent first. This balances the load better
+    than one task per param set when there are few param sets, e.g. a
+    single expensive simulation uses one CPU per grid size.
+    Grid refinement (see _worker_simulate_refined_fs()) is done in
+    rounds: all fs of a round are simulated before the fs failing the
+    quality check are re-simulated on larger grids.
+    Inputs:
+        p_list: list of param values to simulate
+        func, ns, pts_l, folded, cache_dir and cache_size: same as
+            simulate_fs()
+        refine_grids: max number of grid refinements of each fs
+    Return: list of ((fs, number of grid refinements) or None if
+        failed, status of the fs) for each param set
+    '''
+    results = [None] * len(p_list)
+    todo = list(range(len(p_list)))
+    level = 0
+    while todo:
+        level_pts = refine_pts_l(pts_l, level)
+        sim_fs = {}
+        tasks = []
+        for sim_idx in todo:
+            if cache_dir is not None:
+                key = fs_cache_key(func, p_list[sim_idx], ns, level_pts,
+                                   folded)
+                sim_fs[sim_idx] = load_cached_fs(cache_dir, key)
+                if sim_fs[sim_idx] is not None:
+                    continue
+            tasks.extend((sim_idx, grid_idx, p_list[sim_idx], pts)
+                         for grid_idx, pts in enumerate(level_pts))
+        tasks.sort(key=lambda task: -task[3])
+        grid_fs = {}
+        for sim_idx, grid_idx, fs, status in pool.imap_unordered(
+                _grid_worker_func, tasks):
+            if status != FS_OK:
+                results[sim_idx] = (None, status)
+                continue
+            grid_fs.setdefault(sim_idx, [None] * len(level_pts))
+            grid_fs[sim_idx][grid_idx] = fs
+        next_todo = []
+        for sim_idx in todo:
+            if results[sim_idx] is not None and results[sim_idx][1] != FS_OK:
+                continue
+            fs = sim_fs.get(sim_idx)
+            if fs is None:
+                fs = _extrapolate(grid_fs[sim_idx], level_pts)
+                if cache_dir is not None:
+                    save_cached_fs(cache_dir,
+                                   fs_cache_key(func, p_list[sim_idx], ns,
+                                                level_pts, folded),
+                                   fs, cache_size)
+            results[sim_idx] = ((fs, level), FS_OK)
+            if level < refine_grids and _neg_fraction(fs) > NEG_FS_THRESHOLD:
+                next_todo.append(sim_idx)
+        todo = next_todo
+        level += 1
+    return results
+
+
+def simulate_fs_split_grids(p, func, ns, pts_l, folded, cache_dir=None,
+                            cache_size=10000):
+    '''
+    Same as simulate_fs(), but simulating on each grid size of pts_l in
+    parallel, e.g. to lower the latency of a single expensive simulation
+    Return: a single fs
+    '''
+    with Pool(processes=len(pts_l), initializer=_init_worker,
+              initargs=(func, ns, pts_l, folded, None, cache_size, None, 0,
+                        None)) as pool:
+        (output, status), = _simulate_split_grids(
+            pool, [p], func, ns, pts_l, folded, cache_dir, cache_size, 0)
+    if status != FS_OK:
+        raise RuntimeError(f"Simulation of {func.__name__} failed for "
+                           f"params {p}")
+    return output[0]
+
+
+# number of arrays the size of the largest phi of a simulation that dadi
+# holds at once (phi and integration temporaries), measured on 3D models
+_PHI_COPIES = 16
+# memory in MB of a worker besides its simulation (pages of the main
+# process copied on write, model and post-processing)
+_WORKER_MEM = 64
+# number of tasks after which a worker is replaced by a new one, to
+# release the memory that builds up in long-lived workers
+MAX_TASKS_PER_CHILD = 100
+
+
+def estimate_task_mem(ns, pts_l):
+    '''
+    Estimate the peak memory of a worker simulating one fs, from the
+    largest phi array of the simulation (max(pts_l) points per population)
+    Return: memory in MB
+    '''
+    return _PHI_COPIES * 8 * max(pts_l)**len(ns) / 2**20 + _WORKER_MEM
+
+
+def _n_processes(ncpu, max_mem, ns, pts_l, refine_grids):
+    '''
+    Helper function to get the number of workers of a pool: ncpu (all
+    CPUs if None), capped so that the workers fit in max_mem MB of
+    memory (None means no cap). Grid refinement is rare, so memory is
+    reserved for one worker simulating on the largest refined grids
+    while the others simulate on pts_l.
+    '''
+    n_processes = ncpu or os.cpu_count()
+    if max_mem is not None:
+        max_task_mem = estimate_task_mem(ns, refine_pts_l(pts_l, refine_grids))
+        n_fit = 1 + int((max_mem - max_task_mem) //
+                        estimate_task_mem(ns, pts_l))
+        n_processes = max(1, min(n_processes, n_fit))
+    return n_processes
+
+
+def _chunksize(n_tasks, ncpu):
+    '''
+    Helper function to get the number of tasks sent to (and results sent
+    back from) a worker at once, same as the default of Pool.map()
+    '''
+    chunksize, extra = divmod(n_tasks, 4 * (ncpu or os.cpu_count()))
+    return chunksize + 1 if extra else max(chunksize, 1)
+
+
+def _run_chunk(args):
+    '''
+    Helper function for _imap_longest_first() to run a chunk of tasks in
+    a worker, timing each of them
+    Return: list of (task index, output, run time in seconds)
+    '''
+    worker_func, chunk = args
+    results = []
+    for task_idx, task in chunk:
+        start = time.perf_counter()
+        output = worker_func(task)
+        results.append((task_idx, output, time.perf_counter() - start))
+    return results
+
+
+def _cost_chunks(order, cost, n_workers):
+    '''
+    Helper function for _imap_longest_first() to split tasks sorted by
+    decreasing cost into chunks: each chunk holds about 1/4 of the
+    remaining cost per worker, so expensive tasks are sent on their own,
+    cheap ones are batched, and chunks get smaller towards the end of
+    the run to balance the last tasks across workers
+    Return: list of lists of task indices
+    '''
+    chunks = []
+    remaining = cost[order].sum()
+    i = 0
+    while i < len(order):
+        target = remaining / (4 * n_workers)
+        chunk = [order[i]]
+        chunk_cost = cost[order[i]]
+        i += 1
+        while i < len(order) and chunk_cost + cost[order[i]] <= target:
+            chunk.append(order[i])
+            chunk_cost += cost[order[i]]
+            i += 1
+        remaining -= chunk_cost
+        chunks.append(chunk)
+    return chunks
+
+
+def _imap_longest_first(pool, worker_func, tasks, features, ncpu):
+    '''
+    Helper function to run worker_func on each task in the pool with
+    cost-aware scheduling: simulation time varies a lot with the param
+    values, so a pilot of tasks is run first to fit a log-linear model
+    of the run time of a task on its features (e.g. its log-scaled
+    param values), then the other tasks are sent longest-first in
+    chunks from _cost_chunks(), instead of in fixed-size chunks in
+    which a few slow tasks leave one worker running at the end
+    features: 2D array with the features of each task
+    Yields: output of worker_func for each task, in completion order
+    '''
+    n_workers = ncpu or os.cpu_count()
+    n_pilot = min(len(tasks), max(2 * n_workers, len(tasks) // 20))
+    pilot_times = np.zeros(n_pilot)
+    for results in pool.imap_unordered(
+            _run_chunk, [(worker_func, [(i, tasks[i])])
+                         for i in range(n_pilot)]):
+        for task_idx, output, seconds in results:
+            pilot_times[task_idx] = seconds
+            yield output
+    if n_pilot == len(tasks):
+        return
+
+    X = np.column_stack([np.ones(len(tasks)),
+                         np.asarray(features, dtype=float)])
+    coef = np.linalg.lstsq(X[:n_pilot], np.log(pilot_times + 1e-6),
+                           rcond=None)[0]
+    cost = np.exp(X[n_pilot:] @ coef)
+    order = np.argsort(-cost, kind="stable")
+    chunks = [(worker_func, [(n_pilot + j, tasks[n_pilot + j])
+                             for j in chunk])
+              for chunk in _cost_chunks(order, cost, n_workers)]
+    for results in pool.imap_unordered(_run_chunk, chunks):
+        for _, output, _ in results:
+            yield output
+
+
+def _fs_rng(seed, idx, variant_idx=0):
+    '''
+    Helper function to get the random generator used for sampling the fs
+    of the param set at index idx. Each fs gets its own stream derived
+    from seed, so the sampled data does not depend on the order in which
+    fs are processed (e.g. when resuming an interrupted run).
+    Extra dataset variants (variant_idx > 0) get independent streams.
+    '''
+    spawn_key = (idx,) if variant_idx == 0 else (idx, variant_idx)
+    return np.random.default_rng(np.random.SeedSequence(seed,
+                                                        spawn_key=spawn_key))
+
+
+def _sample_fs(fs, rng):
+    '''
+    Poisson-sample an fs, same as dadi.Spectrum.sample() but drawing
+    from the given random generator. Masked entries are set to zero.
+    '''
+    mask = np.ma.getmaskarray(fs)
+    samp = rng.poisson(np.where(mask, 0, fs.data))
+    return dadi.Spectrum(samp, mask=mask, data_folded=fs.folded,
+                         pop_ids=fs.pop_ids)
+
+
+def _check_fs(fs):
+    '''
+    Helper function to quality check a single simulated fs
+    Return: fs with masked entries set to zero and negative entries
+        converted to their absolute value, and quality check stats
+        (column 7 being the status of the fs, FS_OK, and column 8 the
+        number of grid refinements, set by the workers)
+    '''
+    # assign zeros to masked entries of fs
+    fs.flat[0] = 0
+    fs.flat[-1] = 0
+    # the only masked entries of a simulated fs are the corners,
+    # so the quality check can scan the unmasked data directly
+    arr = fs.data
+    neg = arr < 0
+    # quality check each fs: store the number of entries in the fs
+    # that is negative, nan, or infinity
+    fs_qual = np.zeros(9)
+    fs_qual[0] = np.count_nonzero(neg)
+    fs_qual[1] = np.count_nonzero(np.isnan(arr))
+    fs_qual[2] = np.count_nonzero(np.isposinf(arr))
+    # store more detailed stats for negative entries
+    if fs_qual[0] != 0:
+        sum_neg = arr[neg].sum()
+        fs_sum = arr.sum()
+        fs_qual[3:7] = [arr.min(), sum_neg, fs_sum, abs(sum_neg/fs_sum)]
+    # convert any negative entry in fs before further processing
+    return abs(fs), fs_qual
+
+
+def _postprocess_fs(fs, theta, norm, sampling, folded, bootstrap, n_bstr,
+                    rng):
+    '''
+    Helper function to scale, sample, normalize and fold a single
+    quality checked fs from _check_fs()
+    rng: random generator for sampling, from _fs_rng()
+    Return: fs to store (or [fs, array of bootstrap counts] if bootstrap)
+    '''
+    # generate data for bootstrapping
+    if bootstrap:
+        fs_tostore = _sample_fs(theta*fs, rng)
+        # draw all n_bstr bootstrap samples in one call and store them
+        # as a single array of counts instead of n_bstr Spectrum objects,
+        # see get_bootstrap_fs()
+        lam = np.where(np.ma.getmaskarray(fs_tostore), 0, fs_tostore.data)
+        bstr = rng.poisson(lam, size=(n_bstr,) + lam.shape)
+        return [fs_tostore, bstr.astype(np.min_scalar_type(bstr.max(initial=0)))]
+
+    # generate regular data
+    fs_tostore = theta*fs
+    # sampling step, skip if theta==1
+    if sampling and theta != 1:
+        fs_tostore = _sample_fs(theta*fs, rng)
+        # rerun sampling step if fs.sum() is zero
+        while fs_tostore.sum() == 0:
+            fs_tostore = _sample_fs(theta*fs, rng)
+    # normalization step
+    if norm:
+        fs_tostore = fs_tostore/fs_tostore.sum()
+    # fold fs
+    if folded:
+        fs_tostore = fs_tostore.fold()
+    return fs_tostore
+
+
+def _process_fs(fs, theta, norm, sampling, folded, bootstrap, n_bstr, rng):
+    '''
+    Helper function for _shard_worker_func() to quality check and
+    post-process a single simulated fs
+    rng: random generator for sampling, from _fs_rng()
+    Return: fs to store (or [fs, array of bootstrap counts] if bootstrap)
+        and quality check stats of the simulated fs
+    '''
+    fs, fs_qual = _check_fs(fs)
+    return _postprocess_fs(fs, theta, norm, sampling, folded, bootstrap,
+                           n_bstr, rng), fs_qual
 
 
 def generate_fs(func, params_list, logs, theta, ns, pts_l,
                 norm=True, sampling=True, folded=False,
-                bootstrap=False, n_bstr=200, ncpu=None):
+                bootstrap=False, n_bstr=200, ncpu=None, seed=None,
+                cache_dir=None, cache_size=10000, timeout=None,
+                refine_grids=2, split_grids=False, max_mem=None):
     '''
     Parallelized generation of a dataset of multiple fs based on an input
     demographic model and a list of several demographic parameters
@@ -39,90 +541,742 @@ def generate_fs(func, params_list, logs, theta, ns, pts_l,
         n_bstr: number of bootstrap fs per original fs
         n_cpu: integer num of CPUs to use for generating data
             (None means using all)
-    Output: dataset dictionary with format params:fs
+        seed: seed for sampling the fs (None means not reproducible)
+        cache_dir: dir of the simulated fs cache (None means no caching)
+        cache_size: max size of the simulated fs cache in MB
+        timeout: wall-clock time limit in seconds for simulating and
+            post-processing each fs (None means no limit)
+        refine_grids: max number of times a fs whose negative entries
+            exceed NEG_FS_THRESHOLD of its sum is re-simulated, each time
+            on GRID_REFINE_FACTOR times larger grids (see refine_pts_l())
+        split_grids: whether to simulate each param set on each grid
+            size as a separate task, for better load balancing when
+            there are few param sets (see _simulate_split_grids())
+        max_mem: memory budget in MB of the simulations: fewer than
+            ncpu workers are started if their memory estimated by
+            estimate_task_mem() does not fit in it (None means no cap)
+    Output: dataset dictionary with format params:fs, and array of
+        quality check stats of each fs. Param sets whose simulation
+        failed or timed out are left out of the dataset, and their
+        status (FS_FAILED or FS_TIMED_OUT) is in the last column of
+        the quality check stats.
+    '''
+    variant = {"theta": theta, "norm": norm, "sampling": sampling,
+               "folded": folded, "bootstrap": bootstrap, "n_bstr": n_bstr}
+    data_list, qual_check = generate_fs_variants(
+        func, params_list, logs, ns, pts_l, [variant], folded, ncpu, seed,
+        cache_dir, cache_size, timeout=timeout, refine_grids=refine_grids,
+        split_grids=split_grids, max_mem=max_mem)
+    return data_list[0], qual_check
+
+
+def generate_fs_variants(func, params_list, logs, ns, pts_l, variants,
+                         folded=False, ncpu=None, seed=None,
+                         cache_dir=None, cache_size=10000, post_misid=False,
+                         timeout=None, refine_grids=2, split_grids=False,
+                         max_mem=None):
+    '''
+    Parallelized generation of several datasets from a single pass of
+    dadi simulations: each simulated fs is post-processed once for each
+    dataset variant, e.g. a theta=1 training set and a theta=1000 test
+    set, folded and unfolded datasets, or datasets with smaller sample
+    sizes projected from the simulated fs (a projection pyramid).
+    Inputs:
+        func, params_list, logs, ns, pts_l, ncpu, seed, cache_dir,
+            cache_size, timeout, refine_grids, split_grids and max_mem:
+            same as generate_fs(). Simulations use ns, which should be
+            the largest sample sizes of all variants.
+        variants: list of dicts, one per output dataset, with keys theta,
+            norm, sampling, folded, bootstrap and n_bstr (same as the
+            generate_fs() arguments), and optionally ns: sample sizes
+            to project the simulated fs down to (default ns)
+        folded: whether the model is simulated without misid, i.e. for
+            folded fs only. Folding cancels out misid, so folded variants
+            of an unfolded simulation are valid; their params exclude the
+            misid param.
+        post_misid: whether to simulate unfolded fs without misid and
+            apply misid afterwards. Misid is a linear mix of the fs and
+            its reverse, so param sets that only differ in misid (e.g.
+            from add_misid_values()) share a single simulation.
+            Cannot be used with folded variants.
+    Output: list of dataset dictionaries with format params:fs
+        (one per variant), and array of quality check stats of each fs
     '''
     if pts_l is None:
         pts_l = pts_l_func(ns)
+    if folded and not all(variant["folded"] for variant in variants):
+        raise ValueError("Cannot make unfolded fs from a folded simulation")
+    # check before starting the pool: exiting in a worker hangs the pool
+    if any(variant["bootstrap"] and variant["theta"] == 1
+           for variant in variants):
+        sys.exit("Cannot bootstrap fs with theta=1")
+    variant_ns_list = [tuple(variant.get("ns") or ns) for variant in variants]
+    for variant_ns in variant_ns_list:
+        if len(variant_ns) != len(ns) or \
+                any(v_n > n for v_n, n in zip(variant_ns, ns)):
+            raise ValueError(f"Cannot project fs with sample sizes {ns} "
+                             f"to {list(variant_ns)}")
+
+    post_misid = post_misid and not folded
+    if post_misid and any(variant["folded"] for variant in variants):
+        # folding cancels misid, so param sets only differing in misid
+        # would all give the same folded fs
+        raise ValueError("Cannot make folded fs with post_misid")
 
+    # group the param sets by simulation:
+    # with post_misid, param sets only differing in misid are the same
+    sim_dict = {}
+    for idx, p in enumerate(params_list):
+        sim_p = tuple(p[:-1]) if post_misid else idx
+        sim_dict.setdefault(sim_p, []).append((idx, p))
+    # tasks only carry the param values, and the misid value of each
+    # param set if misid is applied after simulation
     arg_list = []
-    for p in params_list:
+    features = []
+    for entries in sim_dict.values():
+        p = entries[0][1]
+        n_p = len(logs) - 1 if post_misid else len(logs)
+        delog_p = [10**p[i] if logs[i] else p[i] for i in range(n_p)]
+        arg_list.append((delog_p, [(idx, params[-1] if post_misid else None)
+                                   for idx, params in entries]))
+        features.append(p[:n_p])
+
+    data_list = [[None] * len(params_list) for _ in variants]
+    qual_check = np.zeros((len(params_list), 9))
+    with tempfile.TemporaryDirectory(prefix="donni_") as out_dir:
+        # workers write the fs of each variant (except bootstrap data)
+        # into a matrix shared through a memory-mapped file, at the row
+        # of the param set, instead of pickling them back to this process
+        out_list = []
+        for variant_idx, (variant, variant_ns) in \
+                enumerate(zip(variants, variant_ns_list)):
+            if variant["bootstrap"] or len(params_list) == 0:
+                out_list.append(None)
+                continue
+            shape = (len(params_list),
+                     int(np.prod([n + 1 for n in variant_ns])))
+            out_file = os.path.join(out_dir, f"variant_{variant_idx}")
+            np.memmap(out_file, dtype=np.float64, mode="w+",
+                      shape=shape).flush()
+            out_list.append((out_file, shape))
+        init_args = ((func, ns, pts_l, folded or post_misid, cache_dir,
+                      cache_size, timeout, refine_grids),
+                     (ns, variants, variant_ns_list, seed), out_list)
+        ncpu = _n_processes(ncpu, max_mem, ns, pts_l, refine_grids)
+        with Pool(processes=ncpu, initializer=_init_variants_worker,
+                  initargs=init_args,
+                  maxtasksperchild=MAX_TASKS_PER_CHILD) as pool:
+            if split_grids:
+                sim_results = _simulate_split_grids(
+                    pool, [delog_p for delog_p, _ in arg_list], func, ns,
+                    pts_l, folded or post_misid, cache_dir, cache_size,
+                    refine_grids)
+                post_args = [sim_result + (entries,) for sim_result,
+                             (_, entries) in zip(sim_results, arg_list)]
+                results_iter = pool.imap_unordered(
+                    _variants_post_func, post_args,
+                    _chunksize(len(post_args), ncpu))
+            else:
+                results_iter = _imap_longest_first(
+                    pool, _variants_worker_func, arg_list, features, ncpu)
+            for results in results_iter:
+                for idx, fs_qual, variant_fs_list in results:
+                    qual_check[idx] = fs_qual
+                    if variant_fs_list is None:  # failed
+                        continue
+                    for variant_idx, fs_tostore in \
+                            enumerate(variant_fs_list):
+                        data_list[variant_idx][idx] = fs_tostore
+        # rebuild the fs written by the workers from the shared matrices
+        for variant_idx, out in enumerate(out_list):
+            if out is None:
+                continue
+            out_file, shape = out
+            fs_shape = tuple(n + 1 for n in variant_ns_list[variant_idx])
+            out_arr = np.memmap(out_file, dtype=np.float64, mode="r",
+                                shape=shape)
+            for idx, fs_info in enumerate(data_list[variant_idx]):
+                if fs_info is None:  # failed
+                    continue
+                packed_mask, fs_folded, pop_ids = fs_info
+                mask = np.unpackbits(packed_mask, count=shape[1])
+                data_list[variant_idx][idx] = dadi.Spectrum(
+                    out_arr[idx].reshape(fs_shape),
+                    mask=mask.astype(bool).reshape(fs_shape),
+                    mask_corners=False, data_folded=fs_folded,
+                    pop_ids=pop_ids)
+            del out_arr
+    if cache_dir is not None:
+        evict_fs_cache(cache_dir, cache_size)
+
+    # assemble the dataset dicts in the order of params_list
+    for variant_idx, variant in enumerate(variants):
+        # drop misid param for folded variants of unfolded fs
+        n_p = -1 if variant["folded"] and not folded else len(logs)
+        data_list[variant_idx] = {
+            tuple(params[:n_p]): fs_tostore for params, fs_tostore
+            in zip(params_list, data_list[variant_idx])
+            if fs_tostore is not None}
+    return data_list, qual_check
+
+
+def _variants_worker_func(args: tuple):
+    '''
+    Helper function for generate_fs_variants() to simulate one fs and
+    quality check and post-process it for each dataset variant in the
+    worker, so that post-processing also runs in parallel
+    args: param values to simulate, and list of (index, misid value
+        applied after simulation or None) of the param sets sharing
+        the simulation
+    Return: list of (index, quality check stats, list of fs to store
+        for each variant) for each param set sharing the simulation.
+        The fs of variants with a shared output matrix are written to
+        it, and only their mask (packed into bits), folding and
+        population ids are returned. The list of fs is None if the
+        simulation or post-processing failed.
+    '''
+    p, entries = args
+    sim_output, status = _worker_run(_worker_simulate_refined_fs, p)
+    return _variants_post_func((sim_output, status, entries))
+
+
+def _variants_post_func(args: tuple):
+    '''
+    Helper function for generate_fs_variants() to quality check and
+    post-process a simulated fs for each dataset variant in the worker
+    args: simulated fs and number of grid refinements (None if failed),
+        status of the simulation, and list of (index, misid value) of
+        the param sets sharing the simulation
+    Return: same as _variants_worker_func()
+    '''
+    sim_output, status, entries = args
+    results = []
+    for idx, misid in entries:
+        if status == FS_OK:
+            output, status = _worker_run(_variants_process_fs, *sim_output,
+                                         idx, misid)
+        if status != FS_OK:
+            fs_qual = np.zeros(9)
+            fs_qual[7] = status
+            results.append((idx, fs_qual, None))
+            continue
+        results.append((idx,) + output)
+    return results
+
+
+def _variants_process_fs(sim_fs, level, idx, misid):
+    '''
+    Helper function for _variants_worker_func() to quality check and
+    post-process a simulated fs for each dataset variant
+    level: number of grid refinements of the simulated fs
+    Return: quality check stats, and list of fs to store for each variant
+    '''
+    ns, variants, variant_ns_list, seed = _worker_state["post_args"]
+    out_list = _worker_state["out"]
+    fs = sim_fs
+    if misid is not None:
+        # makes a new fs, so the shared simulation is not modified
+        fs = dadi.Numerics.apply_anc_state_misid(fs, misid)
+    # project to smaller sample sizes before the quality check,
+    # which unmasks the corners of fs by setting them to zero
+    checked_fs = {variant_ns: fs.project(variant_ns)
+                  for variant_ns in set(variant_ns_list)
+                  if variant_ns != tuple(ns)}
+    for variant_ns, proj_fs in checked_fs.items():
+        checked_fs[variant_ns], _ = _check_fs(proj_fs)
+    checked_fs[tuple(ns)], fs_qual = _check_fs(fs)
+    fs_qual[8] = level
+    variant_fs_list = [
+        _postprocess_fs(checked_fs[variant_ns], variant["theta"],
+                        variant["norm"], variant["sampling"],
+                        variant["folded"], variant["bootstrap"],
+                        variant["n_bstr"], _fs_rng(seed, idx, variant_idx))
+        for variant_idx, (variant, variant_ns)
+        in enumerate(zip(variants, variant_ns_list))]
+    for variant_idx, out_arr in enumerate(out_list):
+        if out_arr is None:
+            continue
+        fs_tostore = variant_fs_list[variant_idx]
+        out_arr[idx] = fs_tostore.data.ravel()
+        variant_fs_list[variant_idx] = (
+            np.packbits(np.ma.getmaskarray(fs_tostore)),
+            fs_tostore.folded, fs_tostore.pop_ids)
+    return fs_qual, variant_fs_list
+
+
+def _shard_worker_func(args: tuple):
+    '''
+    Helper function for generate_fs_shards() to simulate, quality check
+    and post-process one fs in the worker, keeping track of which param
+    set it belongs to since results arrive out of order
+    Return: index of the param set, fs to store (None if failed) and
+        quality check stats
+    '''
+    idx, p = args
+    output, status = _worker_run(_shard_process_fs, idx, p)
+    if status != FS_OK:
+        fs_qual = np.zeros(9)
+        fs_qual[7] = status
+        return idx, None, fs_qual
+    return (idx,) + output
+
+
+def _shard_process_fs(idx, p):
+    '''
+    Helper function for _shard_worker_func() to simulate, quality check
+    and post-process one fs
+    '''
+    theta, norm, sampling, folded, bootstrap, n_bstr, seed = \
+        _worker_state["post_args"]
+    sim_fs, level = _worker_simulate_refined_fs(p)
+    fs_tostore, fs_qual = _process_fs(sim_fs, theta, norm, sampling, folded,
+                                      bootstrap, n_bstr, _fs_rng(seed, idx))
+    fs_qual[8] = level
+    return fs_tostore, fs_qual
+
+
+def _write_shard(shard, shard_qual, outdir, shard_idx):
+    '''
+    Helper function for generate_fs_shards() to pickle one shard of the
+    dataset, along with a progress file recording the index and quality
+    stats of each fs in the shard. Both are first written to temporary
+    files and then renamed, and the shard is renamed last, so that an
+    existing shard file always means that the shard is complete.
+    '''
+    for prefix, obj in [("progress", shard_qual), ("shard", shard)]:
+        fname = os.path.join(outdir, f"{prefix}_{shard_idx:05d}")
+        with open(f"{fname}.tmp", "wb") as fh:
+            pickle.dump(obj, fh)
+        os.replace(f"{fname}.tmp", fname)
+
+
+def _read_progress(outdir):
+    '''
+    Helper function for generate_fs_shards() to read the progress of an
+    interrupted run from its completed shards
+    Return: dict with format index:quality check stats of finished fs,
+        and the index of the next shard to write
+    '''
+    done = {}
+    next_shard_idx = 0
+    for fname in sorted(os.listdir(outdir)):
+        if fname.startswith("shard_") and not fname.endswith(".tmp"):
+            shard_idx = int(fname[len("shard_"):])
+            with open(os.path.join(outdir, f"progress_{shard_idx:05d}"),
+                      "rb") as fh:
+                done.update(pickle.load(fh))
+            next_shard_idx = shard_idx + 1
+    return done, next_shard_idx
+
+
+def generate_fs_shards(func, params_list, logs, theta, ns, pts_l, outdir,
+                       shard_size=1000, norm=True, sampling=True,
+                       folded=False, bootstrap=False, n_bstr=200, ncpu=None,
+                       seed=None, resume=False, cache_dir=None,
+                       cache_size=10000, timeout=None, refine_grids=2,
+                       max_mem=None):
+    '''
+    Streaming version of generate_fs(): fs are post-processed as soon as
+    the workers finish them and appended to fixed-size shards on disk,
+    so peak memory is bounded by shard_size instead of len(params_list).
+    Each shard is a pickled dictionary with format params:fs, i.e. the
+    same format as the output of generate_fs().
+    The shards also serve as a progress store: with resume=True, only
+    the param sets that are not in a completed shard of outdir are
+    simulated. Given the same params_list and seed, the resumed dataset
+    is identical to the one from an uninterrupted run.
+    Inputs:
+        same as generate_fs(), plus
+        outdir: directory to save the shards to
+        shard_size: number of param sets in each shard, failed ones
+            being recorded in the progress file but not in the shard
+        resume: whether to resume an interrupted run saved in outdir
+    Output: array of quality check stats of each fs, ordered as params_list
+    '''
+    if bootstrap and theta == 1:
+        sys.exit("Cannot bootstrap fs with theta=1")
+    if pts_l is None:
+        pts_l = pts_l_func(ns)
+    os.makedirs(outdir, exist_ok=True)
+
+    # settings that must not change between an interrupted and resumed run
+    settings = {"func": func.__name__, "n_samples": len(params_list),
+                "theta": theta, "ns": tuple(ns), "pts_l": tuple(pts_l),
+                "norm": norm, "sampling": sampling, "folded": folded,
+                "bootstrap": bootstrap, "n_bstr": n_bstr, "seed": seed,
+                "refine_grids": refine_grids}
+    settings_file = os.path.join(outdir, "settings")
+    if resume and os.path.exists(settings_file):
+        with open(settings_file, "rb") as fh:
+            if pickle.load(fh) != settings:
+                sys.exit(f"Cannot resume: {outdir} was generated with "
+                         "different settings")
+        done, shard_idx = _read_progress(outdir)
+    else:
+        # remove any shard or progress file left from a previous run
+        for fname in os.listdir(outdir):
+            if fname.startswith(("shard_", "progress_")):
+                os.remove(os.path.join(outdir, fname))
+        with open(settings_file, "wb") as fh:
+            pickle.dump(settings, fh)
+        done, shard_idx = {}, 0
+
+    arg_list = []
+    features = []
+    for idx, p in enumerate(params_list):
+        if idx in done:
+            continue
         delog_p = [10**p[i] if logs[i] else p[i] for i in range(len(logs))]
-        arg_list.append((delog_p, func, ns, pts_l, folded))
-
-    with Pool(processes=ncpu) as pool:
-        fs_list = pool.map(worker_func, arg_list)
-
-    data_dict = {}
-    qual_check = []
-    for params, fs in zip(params_list, fs_list):
-        params = tuple(params)
-        # assign zeros to masked entries of fs
-        fs.flat[0] = 0
-        fs.flat[-1] = 0
-        # quality check each fs: store the number of entries in the fs
-        # that is negative, nan, or infinity
-        num_neg = (fs < 0).sum()
-        num_nan = (np.isnan(fs)).sum()
-        num_inf = (np.isposinf(fs)).sum()
-        fs_qual = [num_neg, num_nan, num_inf]
-        # store more detailed stats for negative entries
-        if np.any(fs < 0):
-            sum_neg = np.sum(fs[fs < 0])
-            fs_qual += [fs.min(), sum_neg, fs.sum(), abs(sum_neg/fs.sum())]
-        else:
-            fs_qual += [0, 0, 0, 0]
-        # append stat for each fs to a list of all fs stats
-        qual_check.append(fs_qual)
-        # convert any negative entry in fs before further processing
-        fs = abs(fs)
-
-        # generate data for bootstrapping
-        if bootstrap:
-            if theta == 1:
-                sys.exit("Cannot bootstrap fs with theta=1")
-            fs_tostore = (theta*fs).sample()
-            data_dict[params] = [fs_tostore, []]
-            for _ in range(n_bstr):  # num bootstrap samples for each fs
-                data_dict[params][1].append(fs_tostore.sample())
-        # generate regular data
+        arg_list.append((idx, delog_p))
+        features.append(p)
+    init_args = (func, ns, pts_l, folded, cache_dir, cache_size, timeout,
+                 refine_grids,
+                 (theta, norm, sampling, folded, bootstrap, n_bstr, seed))
+
+    qual_check = np.zeros((len(params_list), 9))
+    for idx, fs_qual in done.items():
+        qual_check[idx] = fs_qual
+    shard, shard_qual = {}, {}
+    ncpu = _n_processes(ncpu, max_mem, ns, pts_l, refine_grids)
+    with Pool(processes=ncpu, initializer=_init_worker, initargs=init_args,
+              maxtasksperchild=MAX_TASKS_PER_CHILD) as pool:
+        for idx, fs_tostore, fs_qual in _imap_longest_first(
+                pool, _shard_worker_func, arg_list, features, ncpu):
+            if fs_tostore is not None:
+                shard[tuple(params_list[idx])] = fs_tostore
+            shard_qual[idx] = fs_qual
+            qual_check[idx] = fs_qual
+            if len(shard_qual) == shard_size:
+                _write_shard(shard, shard_qual, outdir, shard_idx)
+                shard, shard_qual = {}, {}
+                shard_idx += 1
+    # write the last partially filled shard
+    if len(shard_qual) != 0:
+        _write_shard(shard, shard_qual, outdir, shard_idx)
+    if cache_dir is not None:
+        evict_fs_cache(cache_dir, cache_size)
+    return qual_check
+
+
+def load_data(data_path):
+    '''
+    Load a dataset saved by donni generate_data
+    Input: path to a pickled data dict, to a dir of shards saved by
+        generate_fs_shards(), or to a dir saved by save_array_data()
+    Output: dataset dictionary with format params:fs
+    '''
+    if not os.path.isdir(data_path):
+        with open(data_path, "rb") as fh:
+            return pickle.load(fh)
+    if is_array_data(data_path):
+        X, params, mask, metadata = load_array_data(data_path)
+        return {tuple(p): dadi.Spectrum(x.reshape(metadata["shape"]),
+                                        mask=mask,
+                                        data_folded=metadata["folded"])
+                for p, x in zip(params.tolist(), X)}
+    data = {}
+    for shard_file in sorted(os.listdir(data_path)):
+        if shard_file.startswith("shard_") and \
+                not shard_file.endswith(".tmp"):
+            with open(os.path.join(data_path, shard_file), "rb") as fh:
+                data.update(pickle.load(fh))
+    return data
+
+
+# version of the array dataset format written by save_array_data()
+# 2: optional integer counts (X.npy) with row totals (totals.npy)
+ARRAY_DATA_VERSION = 2
+
+
+def save_array_data(data, outdir, metadata, counts=False):
+    '''
+    Save a dataset in the array format: a dir holding
+        X.npy: float32 matrix of the flattened fs, one row per fs,
+            with masked entries set to zero
+        params.npy: float64 matrix of the param values of each row
+        mask.npy: mask shared by all fs, with the shape of the fs
+        metadata.json: format version, fs shape and folding, and the
+            given metadata (e.g. model, theta and logs)
+    Each .npy file can be memory-mapped with np.load(mmap_mode="r").
+    Inputs:
+        data: dataset dictionary with format params:fs
+        outdir: dir to save the dataset to
+        metadata: dict of JSON-serializable settings of the dataset
+        counts: whether to save the fs, which must be non-normalized
+            sampled fs, as uint16 (or uint32 if needed) counts in X.npy
+            and their sums in totals.npy. With metadata["norm"], the
+            fs are normalized when loaded by load_array_data().
+    '''
+    params_list = list(data.keys())
+    first_fs = data[params_list[0]]
+    if not isinstance(first_fs, dadi.Spectrum):
+        raise ValueError("Cannot save bootstrap data in the array format")
+    mask = np.ma.getmaskarray(first_fs)
+    dtype = np.float32
+    if counts:
+        max_count = max(np.ma.filled(fs, 0).max() for fs in data.values())
+        dtype = np.promote_types(np.min_scalar_type(int(max_count)),
+                                 np.uint16)
+        totals = np.empty(len(data))
+    os.makedirs(outdir, exist_ok=True)
+    # fill the matrix on disk row by row instead of stacking the fs
+    X = np.lib.format.open_memmap(os.path.join(outdir, "X.npy"), mode="w+",
+                                  dtype=dtype,
+                                  shape=(len(data), first_fs.size))
+    for i, fs in enumerate(data.values()):
+        if not np.array_equal(np.ma.getmaskarray(fs), mask):
+            raise ValueError("Cannot save fs with different masks "
+                             "in the array format")
+        row = np.ma.filled(fs, 0).ravel()
+        if counts:
+            if np.any(row != np.round(row)) or np.any(row < 0):
+                raise ValueError("Cannot save fs that are not sampled "
+                                 "counts as counts")
+            totals[i] = row.sum()
+        X[i] = row
+    X.flush()
+    del X
+    if counts:
+        np.save(os.path.join(outdir, "totals.npy"), totals)
+    np.save(os.path.join(outdir, "params.npy"),
+            np.array(params_list, dtype=np.float64))
+    np.save(os.path.join(outdir, "mask.npy"), mask)
+    header = dict(metadata, version=ARRAY_DATA_VERSION,
+                  shape=list(first_fs.shape), folded=bool(first_fs.folded),
+                  counts=counts)
+    with open(os.path.join(outdir, "metadata.json"), "w") as fh:
+        json.dump(header, fh, indent=2)
+
+
+def is_array_data(data_path):
+    '''
+    Check if data_path is a dataset saved by save_array_data()
+    '''
+    return os.path.isfile(os.path.join(data_path, "metadata.json"))
+
+
+def load_array_data(data_path, mmap_mode="r", raw_counts=False):
+    '''
+    Load a dataset saved by save_array_data()
+    Inputs:
+        data_path: dir of the dataset
+        mmap_mode: np.load() memory-map mode of the fs and param
+            matrices (None means loading them into memory)
+        raw_counts: whether to get the stored integer counts of a
+            dataset saved with counts=True. By default, counts are
+            converted into a float32 matrix in memory, normalized by
+            the row totals if metadata["norm"].
+    Output: fs matrix, param matrix, shared mask and metadata dict
+    '''
+    with open(os.path.join(data_path, "metadata.json")) as fh:
+        metadata = json.load(fh)
+    if metadata.get("version", 0) > ARRAY_DATA_VERSION:
+        raise ValueError(f"{data_path} was saved by a newer version of "
+                         "donni, with array format version "
+                         f"{metadata['version']}")
+    X = np.load(os.path.join(data_path, "X.npy"), mmap_mode=mmap_mode)
+    if metadata.get("counts") and not raw_counts:
+        totals = np.load(os.path.join(data_path, "totals.npy"))
+        if not metadata["norm"]:
+            totals = np.ones_like(totals)
+        counts, X = X, np.empty(X.shape, dtype=np.float32)
+        # convert in blocks of rows to bound the temporary memory
+        for i in range(0, len(X), 1024):
+            np.divide(counts[i:i+1024], totals[i:i+1024, None],
+                      out=X[i:i+1024], dtype=np.float32)
+    params = np.load(os.path.join(data_path, "params.npy"),
+                     mmap_mode=mmap_mode)
+    mask = np.load(os.path.join(data_path, "mask.npy"))
+    return X, params, mask, metadata
+
+
+def data_chunks(data_path, chunk_size=1000):
+    '''
+    Split a dataset saved by save_array_data() or generate_fs_shards()
+    into chunks that load_data_chunk() loads one at a time, e.g. to
+    stream datasets larger than memory
+    Inputs:
+        data_path: dir of the dataset
+        chunk_size: number of rows in each chunk of the array format
+            (each shard being one chunk)
+    Output: list of (file, start, stop) of the rows of each chunk
+    '''
+    if is_array_data(data_path):
+        n_rows = len(np.load(os.path.join(data_path, "params.npy"),
+                             mmap_mode="r"))
+        return [("X.npy", start, min(start + chunk_size, n_rows))
+                for start in range(0, n_rows, chunk_size)]
+    if not os.path.isdir(data_path):
+        raise ValueError(f"{data_path} is not a dataset in the array "
+                         "format or a dir of shards")
+    chunks = []
+    for fname in sorted(os.listdir(data_path)):
+        if fname.startswith("shard_") and not fname.endswith(".tmp"):
+            # count the fs from the progress file instead of loading
+            # the shard, failed fs being only in the progress file
+            shard_idx = fname[len("shard_"):]
+            with open(os.path.join(data_path, f"progress_{shard_idx}"),
+                      "rb") as fh:
+                n_rows = sum(fs_qual[7] == FS_OK
+                             for fs_qual in pickle.load(fh).values())
+            chunks.append((fname, 0, n_rows))
+    return chunks
+
+
+def load_data_chunk(data_path, chunk):
+    '''
+    Load the rows of a chunk from data_chunks()
+    Output: float32 matrix of the flattened fs, one row per fs
+        (normalized as by load_array_data() for counts), and param matrix
+    '''
+    fname, start, stop = chunk
+    if fname == "X.npy":
+        X, params, _, metadata = load_array_data(data_path, raw_counts=True)
+        if metadata.get("counts") and metadata["norm"]:
+            totals = np.load(os.path.join(data_path, "totals.npy"))
+            X_chunk = np.divide(X[start:stop], totals[start:stop, None],
+                                dtype=np.float32)
         else:
-            fs_tostore = theta*fs
-            # sampling step, skip if theta==1
-            if sampling and theta != 1:
-                fs_tostore = fs_tostore.sample()
-                # rerun sampling step if fs.sum() is zero
-                while fs_tostore.sum() == 0:
-                    fs_tostore = theta*fs.sample()
-            # normalization step
-            if norm:
-                fs_tostore = fs_tostore/fs_tostore.sum()
-            # fold fs
-            if folded:
-                fs_tostore = fs_tostore.fold()
-            data_dict[params] = fs_tostore
-    return data_dict, qual_check
-
-
-def fs_quality_check(qual_check, filename, params_list, param_names, logs):
+            X_chunk = np.array(X[start:stop], dtype=np.float32)
+        return X_chunk, np.array(params[start:stop])
+    with open(os.path.join(data_path, fname), "rb") as fh:
+        shard = pickle.load(fh)
+    # flattened as by donni.train.prep_data()
+    X_chunk = np.array([np.array(fs).flatten()
+                        for fs in list(shard.values())[start:stop]],
+                       dtype=np.float32)
+    return X_chunk, np.array(list(shard.keys())[start:stop])
+
+
+def save_individual_fs(data, outdir):
+    '''
+    Save each fs of a dataset for random access by index in a single
+    container instead of one file per fs: a dir holding
+        fs_data.bin: float64 values of all fs, one after the other
+        fs_mask.bin: masks of all fs, with the same layout
+        fs_index.npy: int64 matrix with one row per fs: offset (in
+            values) of the fs in fs_data.bin, whether it is folded,
+            and its shape (padded with zeros)
+        true_log_params: pickled list of the param values of each fs
+    Inputs:
+        data: dataset dictionary with format params:fs
+        outdir: dir to save the container to
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    max_ndim = max(fs.ndim for fs in data.values())
+    index = np.zeros((len(data), 2 + max_ndim), dtype=np.int64)
+    offset = 0
+    with open(os.path.join(outdir, "fs_data.bin"), "wb") as data_fh, \
+            open(os.path.join(outdir, "fs_mask.bin"), "wb") as mask_fh:
+        for i, fs in enumerate(data.values()):
+            index[i, :2] = offset, fs.folded
+            index[i, 2:2+fs.ndim] = fs.shape
+            data_fh.write(np.ascontiguousarray(fs.data,
+                                               dtype=np.float64).tobytes())
+            mask_fh.write(np.ma.getmaskarray(fs).tobytes())
+            offset += fs.size
+    np.save(os.path.join(outdir, "fs_index.npy"), index)
+    with open(os.path.join(outdir, "true_log_params"), "wb") as fh:
+        pickle.dump(list(data.keys()), fh)
+
+
+def load_individual_fs(outdir, idx=None):
+    '''
+    Read fs from a container saved by save_individual_fs(), only
+    reading the requested fs from disk
+    Inputs:
+        outdir: dir of the container
+        idx: index (or list of indices) of the fs to read, in the
+            order of the true_log_params list (None means all)
+    Output: fs (or list of fs if idx is not a single index)
+    '''
+    index = np.load(os.path.join(outdir, "fs_index.npy"))
+    if idx is None:
+        idx = range(len(index))
+    if not np.isscalar(idx):
+        return [load_individual_fs(outdir, i) for i in idx]
+    values = np.memmap(os.path.join(outdir, "fs_data.bin"), mode="r",
+                       dtype=np.float64)
+    masks = np.memmap(os.path.join(outdir, "fs_mask.bin"), mode="r",
+                      dtype=np.bool_)
+    offset, folded = index[idx, :2]
+    shape = tuple(n for n in index[idx, 2:] if n != 0)
+    size = int(np.prod(shape))
+    return dadi.Spectrum(
+        np.array(values[offset:offset+size]).reshape(shape),
+        mask=np.array(masks[offset:offset+size]).reshape(shape),
+        data_folded=bool(folded))
+
+
+def export_individual_fs(outdir, export_dir=None, idx=None):
+    '''
+    Write fs from a container saved by save_individual_fs() as
+    individual dadi fs files named fs_{i:03d}
+    Inputs:
+        outdir: dir of the container
+        export_dir: dir to write the fs files to (None means outdir)
+        idx: list of indices of the fs to export (None means all)
+    '''
+    export_dir = outdir if export_dir is None else export_dir
+    os.makedirs(export_dir, exist_ok=True)
+    if idx is None:
+        idx = range(len(np.load(os.path.join(outdir, "fs_index.npy"))))
+    for i in idx:
+        load_individual_fs(outdir, i).tofile(
+            os.path.join(export_dir, f"fs_{i:03d}"))
+
+
+def get_bootstrap_fs(fs, bstr, idx=None):
+    '''
+    Get bootstrap fs from a bootstrap dataset entry [fs, bstr]
+    Inputs:
+        fs: sampled fs the bootstrap samples were drawn from
+        bstr: array of bootstrap counts with shape (n_bstr,) + fs.shape
+        idx: index of the bootstrap fs to get (None means all)
+    Output: bootstrap fs with the same mask as fs (or list of all
+        bootstrap fs if idx is None)
+    '''
+    if idx is None:
+        return [get_bootstrap_fs(fs, bstr, i) for i in range(len(bstr))]
+    return dadi.Spectrum(bstr[idx], mask=np.ma.getmaskarray(fs),
+                         data_folded=fs.folded, pop_ids=fs.pop_ids)
+
+
+def fs_quality_check(qual_check, filename, params_list, param_names, logs,
+                     pts_l=None):
     """
     Method for checking FS quality and print output.
     Inputs:
-        qual_check: from generate_fs()
+        qual_check: array of quality check stats of each fs,
+            from generate_fs()
         filename: from CLI input
         params_list: demographic model param sets
         param_names: demographic model parameter names
         logs: indicate which dem param is in log10 values
+        pts_l: grid sizes of the run, to report the grid sizes of
+            re-simulated fs (None means reporting their number of
+            grid refinements)
     """
-    qual_arr = np.array(qual_check)
+    qual_arr = np.asarray(qual_check)
     neg_fs = np.count_nonzero(qual_arr[:, 0])
     nan_fs = np.count_nonzero(qual_arr[:, 1])
     inf_fs = np.count_nonzero(qual_arr[:, 2])
     # get index of FS with negative entries
     neg_fs_idx = list(np.where(qual_arr[:, 0] > 0)[0])
     # get index of FS with negative entries above threshold
-    bad_fs_idx = list(np.where(qual_arr[:, 6] > 0.001)[0])
+    bad_fs_idx = list(np.where(qual_arr[:, 6] > NEG_FS_THRESHOLD)[0])
+    # get index of FS re-simulated on larger grids
+    refined_fs_idx = list(np.where(qual_arr[:, 8] > 0)[0])
+    # get index of FS left out of the dataset
+    failed_fs_idx = list(np.where(qual_arr[:, 7] != FS_OK)[0])
     with open(f'{filename}_quality.txt', 'w') as fh:
         fh.write(f'Quality check for {filename}:\n')
+        fh.write('Number of FS whose simulation failed: '
+                 f'{np.count_nonzero(qual_arr[:, 7] == FS_FAILED)}\n')
+        fh.write('Number of FS whose simulation timed out: '
+                 f'{np.count_nonzero(qual_arr[:, 7] == FS_TIMED_OUT)}\n')
+        fh.write('Number of FS re-simulated on larger grids: '
+                 f'{len(refined_fs_idx)}\n')
         fh.write('Number of FS with at least one negative entry: '
                  f'{neg_fs}\n')
         fh.write('Number of FS with at least one NaN entry: '
@@ -136,9 +1290,11 @@ def fs_quality_check(qual_check, filename, params_list, param_names, logs):
             fh.write('Any FS with negative entries sum to more than'
                      ' 0.1% of the sum of all entries in FS'
                      ' before conversion will be reported below.\n')
-            fh.write('To reduce the number of FS with negative entries'
-                     ' in initial simulations try increasing the grids'
-                     ' size.\n\n')
+            fh.write('FS with negative entries above this threshold'
+                     ' are re-simulated on larger grids, up to'
+                     ' --refine_grids times. To reduce the number of FS'
+                     ' with negative entries in initial simulations try'
+                     ' increasing the grids size.\n\n')
         if len(bad_fs_idx) != 0:
             fh.write(f'{"-"*60}\n\n')
             fh.write('Details of FS with negative entries exceeding '
@@ -157,7 +1313,36 @@ def fs_quality_check(qual_check, filename, params_list, param_names, logs):
                 fh.write('Sum of all negative entries: '
                          f'{round(qual_arr[:,4][idx], 4)}\n')
                 fh.write('Sum of FS before normalization: '
-                         f'{round(qual_arr[:,5][idx], 4)}\n\n')
+                         f'{round(qual_arr[:,5][idx], 4)}\n')
+                fh.write(f'{_grids_used(qual_arr[idx, 8], pts_l)}\n\n')
+        if len(refined_fs_idx) != 0:
+            fh.write(f'{"-"*60}\n\n')
+            fh.write('Details of FS re-simulated on larger grids:\n\n')
+            for idx in refined_fs_idx:
+                fh.write(f'FS {idx}: {_grids_used(qual_arr[idx, 8], pts_l)}'
+                         '\n')
+            fh.write('\n')
+        if len(failed_fs_idx) != 0:
+            fh.write(f'{"-"*60}\n\n')
+            fh.write('Details of FS left out of the dataset:\n\n')
+            for idx in failed_fs_idx:
+                status = ('timed out' if qual_arr[idx, 7] == FS_TIMED_OUT
+                          else 'failed')
+                fh.write(f'FS {idx} ({status}):\n')
+                fh.write('Params: ')
+                for p, log, p_val in zip(param_names, logs, params_list[idx]):
+                    p_val_delog = 10**p_val if log else p_val
+                    fh.write(f'{str(p)}={round(p_val_delog, 3)} ')
+                fh.write('\n\n')
+
+
+def _grids_used(level, pts_l):
+    """
+    Helper method for fs_quality_check to describe the grids of a fs
+    """
+    if pts_l is None:
+        return f'Grid refinements: {int(level)}'
+    return f'Grid sizes: {refine_pts_l(pts_l, int(level))}'
 
 
 def pts_l_func(sample_sizes):
@@ -1,7 +1,8 @@
 '''Module for using trained MLPR to make demographic param predictions'''
 import numpy as np
 import dadi
-from donni.generate_data import pts_l_func
+from donni.generate_data import pts_l_func, simulate_fs, \
+    simulate_fs_split_grids
 from tensorflow import keras
 from scipy.stats import norm
 
@@ -40,13 +41,12 @@ def project_fs(input_fs):
     return projected_fs
 
 
-def estimate_theta(pred, func, fs):
-    # (p, func, ns, pts_l, folded) = args
-    if not fs.folded:
-        func = dadi.Numerics.make_anc_state_misid_func(func)
-    func_ex = dadi.Numerics.make_extrap_func(func)
-    grid_pts = pts_l_func(fs.sample_sizes)
-    model_fs = func_ex(pred, fs.sample_sizes, grid_pts)
+def estimate_theta(pred, func, fs, cache_dir=None, cache_size=10000,
+                   pts_l=None, split_grids=False):
+    grid_pts = pts_l_func(fs.sample_sizes) if pts_l is None else pts_l
+    simulate = simulate_fs_split_grids if split_grids else simulate_fs
+    model_fs = simulate(pred, func, fs.sample_sizes, grid_pts, fs.folded,
+                        cache_dir, cache_size)
     return dadi.Inference.optimal_sfs_scaling(model_fs, fs)
 
 
@@ -183,7 +183,8 @@ def irods_cleanup(dem_model, sample_sizes, fold=True):
         print("Directory for model configuration not found.")
 
 
-def infer(filename_list, mlpr_dir, func, input_fs, logs, cis=[95]):
+def infer(filename_list, mlpr_dir, func, input_fs, logs, cis=[95],
+          cache_dir=None, cache_size=10000, pts_l=None, split_grids=False):
     '''
     Inputs:
         models: list of single mlpr object if sklearn,
@@ -194,6 +195,13 @@ def infer(filename_list, mlpr_dir, func, input_fs, logs, cis=[95]):
             individual params
         if not mapie, should be list of length 1
         cis: list of confidence intervals to calculate
+        cache_dir: dir of the simulated fs cache for estimating theta
+            (None means no caching)
+        cache_size: max size of the simulated fs cache in MB
+        pts_l: grid sizes for estimating theta (None means the default
+            grids from pts_l_func())
+        split_grids: whether to simulate the fs for estimating theta on
+            each grid size in parallel
     Outputs:
         pred_list: if mapie, outputs list prediction for each param
         ci_list: if mapie, outputs list of prediction intervals for each
@@ -236,6 +244,7 @@ def infer(filename_list, mlpr_dir, func, input_fs, logs, cis=[95]):
     if sum([inferred_p < 0 for inferred_p in pred_list]) > 0:
         theta = np.nan
     else:
-        theta = estimate_theta(pred_list, func, input_fs)
+        theta = estimate_theta(pred_list, func, input_fs,
+                               cache_dir, cache_size, pts_l, split_grids)
     
     return pred_list, theta, ci_list
\ No newline at end of file
@@ -3,8 +3,10 @@ Module for training and tuning MVEnn with dadi-simulated data
 """
 import logging
 import os
-from multiprocessing import Pool
+import tempfile
+from multiprocessing import Pool, Queue
 import numpy as np
+from donni.generate_data import data_chunks, load_data_chunk
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # FATAL
 logging.getLogger("tensorflow").setLevel(logging.FATAL)
@@ -38,6 +40,15 @@ def prep_data(data: dict, single_output=True):
     return np.array(X_input), y_label_unpack
 
 
+# number of fs in each chunk of the array format loaded by
+# _pipeline_datasets(), and number of chunks loaded at once
+_PIPELINE_CHUNK_SIZE = 1000
+_PIPELINE_CYCLE_LENGTH = 4
+
+# state of a train worker process, set by _init_train_worker()
+_worker_state = {}
+
+
 def regression_nll_loss(sigma_sq, epsilon=1e-6):
     """Custom loss function to train both mean and variance"""
     def nll_loss(y_true, y_pred):
@@ -47,33 +58,210 @@ def regression_nll_loss(sigma_sq, epsilon=1e-6):
     return nll_loss
         
 
+def _build_models(n_features, n_params, units_1, units_2, lr):
+    """
+    Build a MLPR with a hidden layer (trunk) over the flattened fs shared
+    by one head per dem param, each head being a second hidden layer with
+    mean and variance outputs. With n_params=1, this is the MLPR of a
+    single dem param.
+    Output: model to train, compiled with the sum of the NLL of the heads,
+            and list of prediction models (mean and variance outputs) of
+            each dem param, sharing the layers of the trained model
+    """
+    inp = Input(shape=n_features)
+    trunk = Dense(units_1, activation="relu")(inp)
+    means, variances = [], []
+    for _ in range(n_params):
+        x = Dense(units_2, activation="relu")(trunk)
+        means.append(Dense(1, activation="linear")(x))
+        variances.append(Dense(1, activation="softplus")(x))
+
+    train_model = Model(inp, means)
+    # keras sums the losses of the outputs
+    train_model.compile(
+        loss=[regression_nll_loss(var) for var in variances],
+        optimizer=keras.optimizers.legacy.Adam(learning_rate=lr),
+        metrics=[keras.metrics.RootMeanSquaredError()],
+    )
+    pred_models = [Model(inp, [mean, var])
+                   for mean, var in zip(means, variances)]
+    return train_model, pred_models
+
+
+def _shared_matrix_file(X_input, tmp_dir):
+    """
+    Get a .npy file of X_input that the train workers memory-map instead
+    of each receiving a pickled copy of it
+    Output: the file X_input is memory-mapped from (e.g. by
+            load_array_data()), or else a copy of X_input in tmp_dir
+    """
+    if isinstance(X_input, np.memmap) and X_input.filename is not None \
+            and X_input.filename.endswith(".npy"):
+        # X_input may be a view of only part of the file
+        X_disk = np.load(X_input.filename, mmap_mode="r")
+        if (X_disk.offset, X_disk.shape, X_disk.strides, X_disk.dtype) == \
+                (X_input.offset, X_input.shape, X_input.strides,
+                 X_input.dtype):
+            return X_input.filename
+    X_fname = os.path.join(tmp_dir, "X.npy")
+    # keras trains in float32 anyway, and the copy is written in blocks
+    # of rows to avoid loading a memory-mapped X_input at once
+    X = np.lib.format.open_memmap(X_fname, mode="w+", dtype=np.float32,
+                                  shape=X_input.shape)
+    for i in range(0, len(X_input), 1024):
+        X[i:i+1024] = X_input[i:i+1024]
+    X.flush()
+    return X_fname
+
+
+def _poisson_augment(X, theta_range):
+    """
+    Replace each fs (row of X) by a normalized Poisson sample of theta
+    times the fs, theta being drawn log-uniformly from theta_range for
+    each fs, anew every time the pipeline is iterated
+    """
+    log_theta = tf.random.uniform([tf.shape(X)[0], 1],
+                                  np.log(theta_range[0]),
+                                  np.log(theta_range[1]))
+    counts = tf.random.poisson([], tf.exp(log_theta) * X)
+    # a sample without any count is left as zeros
+    return tf.math.divide_no_nan(
+        counts, tf.reduce_sum(counts, axis=1, keepdims=True))
+
+
+def _pipeline_datasets(data, labels, stream, batch_size, shuffle_buffer,
+                       theta_range, val_fraction=0.2):
+    """
+    Build tf.data pipelines of the training and validation fs: chunks of
+    rows are loaded in parallel, in a new random order each epoch for
+    training, and the training fs are shuffled in a buffer of
+    shuffle_buffer fs before batching. With theta_range, the fs of each
+    batch are then resampled by _poisson_augment().
+    Inputs:
+        data, labels: with stream, dataset dir from save_array_data() or
+            generate_fs_shards() streamed from disk, and index of the
+            dem param of each output of the MLPR in the dataset, the
+            last val_fraction of the rows of each chunk being for
+            validation. Else, .npy file of the fs matrix from
+            _shared_matrix_file() and labels of each output, the last
+            val_fraction of the rows being for validation, as with the
+            validation_split of Model.fit().
+        batch_size: number of fs in each batch
+        shuffle_buffer: number of fs in the shuffle buffer
+        theta_range: (min, max) theta of the Poisson resampling, or None
+    Output: dict of the data arguments of Model.fit(), with the training
+            and validation datasets repeated indefinitely, and number of
+            fs features
+    """
+    if stream:
+        chunks = data_chunks(data, _PIPELINE_CHUNK_SIZE)
+        split_chunks = {"train": [], "val": []}
+        for fname, start, stop in chunks:
+            n_val = int(val_fraction * (stop - start))
+            split_chunks["train"].append((fname, start, stop - n_val))
+            split_chunks["val"].append((fname, stop - n_val, stop))
+        n_features = load_data_chunk(data, chunks[0])[0].shape[1]
+
+        def load_chunk(chunk):
+            X, params = load_data_chunk(data, chunk)
+            return X, params[:, labels].astype(np.float32)
+    else:
+        X_input = np.load(data, mmap_mode="r")
+        y = np.array(labels, dtype=np.float32).T
+        n_features = X_input.shape[1]
+        split_at = int(len(X_input) * (1 - val_fraction))
+        split_chunks = {
+            split: [(None, start, min(start + _PIPELINE_CHUNK_SIZE, stop))
+                    for start in range(first, stop, _PIPELINE_CHUNK_SIZE)]
+            for split, first, stop in [("train", 0, split_at),
+                                       ("val", split_at, len(X_input))]}
+
+        def load_chunk(chunk):
+            _, start, stop = chunk
+            return np.array(X_input[start:stop], dtype=np.float32), \
+                y[start:stop]
+
+    def make_dataset(split):
+        split_list = [chunk for chunk in split_chunks[split]
+                      if chunk[2] > chunk[1]]
+
+        def decode(i):
+            X, y = tf.numpy_function(lambda i: load_chunk(split_list[i]),
+                                     [i], [tf.float32, tf.float32])
+            X.set_shape([None, n_features])
+            y.set_shape([None, len(labels)])
+            return tf.data.Dataset.from_tensor_slices((X, y))
+
+        def process_batch(X, y):
+            if theta_range is not None:
+                X = _poisson_augment(X, theta_range)
+            return X, tuple(y[:, i:i+1] for i in range(len(labels)))
+
+        dataset = tf.data.Dataset.range(len(split_list))
+        if split == "train":
+            dataset = dataset.shuffle(len(split_list))
+        # only a few chunks are decoded at once to bound the memory
+        dataset = dataset.repeat().interleave(
+            decode, cycle_length=_PIPELINE_CYCLE_LENGTH,
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=split == "val")
+        if split == "train":
+            dataset = dataset.shuffle(shuffle_buffer)
+        dataset = dataset.batch(batch_size).map(
+            process_batch, num_parallel_calls=tf.data.AUTOTUNE)
+        if "cpus" in _worker_state:
+            # tf.data has its own thread pool, sized to all CPUs by default
+            options = tf.data.Options()
+            options.threading.private_threadpool_size = \
+                len(_worker_state["cpus"])
+            dataset = dataset.with_options(options)
+        steps = -(-sum(stop - start for _, start, stop in split_list)
+                  // batch_size)
+        return dataset.prefetch(tf.data.AUTOTUNE), steps
+
+    train_dataset, train_steps = make_dataset("train")
+    val_dataset, val_steps = make_dataset("val")
+    fit_data = {"x": train_dataset, "steps_per_epoch": train_steps,
+                "validation_data": val_dataset,
+                "validation_steps": val_steps}
+    return fit_data, n_features
+
+
 def _train_worker_func(args):
-    X_input, y_label, param_idx, outdir, tuning = args
+    """
+    Tune and train the MLPR of some dem params, and save one prediction
+    model per param, starting at param_idx. With more than one param,
+    the params are trained together in one shared-trunk MLPR.
+    Without pipeline, data is a .npy file of the fs matrix,
+    memory-mapped read-only so that all workers share one copy of it in
+    the page cache, and labels has the labels of each param.
+    With pipeline (dict of the settings of _pipeline_datasets()), the
+    data is fed by tf.data pipelines instead.
+    """
+    data, labels, param_idx, outdir, tuning, pipeline = args
     from tensorflow.python.framework.ops import disable_eager_execution
     disable_eager_execution()
+    if pipeline is None:
+        X_input = np.load(data, mmap_mode="r")
+        fit_data = {"x": X_input,
+                    "y": [np.array(y_label) for y_label in labels],
+                    "validation_split": 0.2}
+        n_features = X_input.shape[1]
+    else:
+        fit_data, n_features = _pipeline_datasets(data, labels, **pipeline)
+    tuning_name = param_idx if len(labels) == 1 else "shared"
     
     def model_builder(hp):
         """Hyperparam tuning"""
-        inp = Input(shape=X_input.shape[1])
-        x = Dense(
-            units=hp.Int("units_1", min_value=16, max_value=64, step=16),
-            activation="relu",
-        )(inp)
-        x = Dense(
-            units=hp.Int("units_2", min_value=4, max_value=16, step=4),
-            activation="relu",
-        )(x)
-        mean = Dense(1, activation="linear")(x)
-        var = Dense(1, activation="softplus")(x)
-
-        train_model = Model(inp, mean)
-        lr = hp.Float(
-            "lr", min_value=1e-4, max_value=1e-2, sampling="log", default=0.001
-        )
-        train_model.compile(
-            loss=regression_nll_loss(var),
-            optimizer=keras.optimizers.legacy.Adam(learning_rate=lr),
-            metrics=[keras.metrics.RootMeanSquaredError()],
+        train_model, _ = _build_models(
+            n_features,
+            len(labels),
+            hp.Int("units_1", min_value=16, max_value=64, step=16),
+            hp.Int("units_2", min_value=4, max_value=16, step=4),
+            hp.Float(
+                "lr", min_value=1e-4, max_value=1e-2, sampling="log",
+                default=0.001
+            ),
         )
         return train_model
 
@@ -84,15 +272,13 @@ def _train_worker_func(args):
             objective="val_loss",
             max_epochs=100, # default is 100
             directory="tuning_outdir",
-            project_name=f"mvenn_tuning_{param_idx}",
+            project_name=f"mvenn_tuning_{tuning_name}",
             overwrite=True,
         )
 
         # Run the hyperparameter search
         tuner.search(
-            X_input,
-            y_label,
-            validation_split=0.2,
+            **fit_data,
             verbose=0,
             )
         # print tuner results to stdout
@@ -113,15 +299,13 @@ def _train_worker_func(args):
             objective="val_loss",
             max_trials=100, # default to 10
             directory="tuning_outdir",
-            project_name=f"lr_random_{param_idx}",
+            project_name=f"lr_random_{tuning_name}",
             overwrite=True,
             )
         
         tuner.search(
-            X_input,
-            y_label,
+            **fit_data,
             epochs=50,
-            validation_split=0.2,
             verbose=0,
             )
             
@@ -140,38 +324,153 @@ def _train_worker_func(args):
 
     # initiate model from chosen hyperparams and train
 
-    inp = Input(shape=X_input.shape[1])
-    x = Dense(best_hp.get("units_1"), activation="relu")(inp)
-    x = Dense(best_hp.get("units_2"), activation="relu")(x)
-
-    mean = Dense(1, activation="linear")(x)
-    var = Dense(1, activation="softplus")(x)
-
-    train_model = Model(inp, mean)
-    pred_model = Model(inp, [mean, var])
-
-    lr = best_hp.get("lr")
-    train_model.compile(
-        loss=regression_nll_loss(var),
-        optimizer=keras.optimizers.legacy.Adam(learning_rate=lr),
-        metrics=[keras.metrics.RootMeanSquaredError()],
+    train_model, pred_models = _build_models(
+        n_features,
+        len(labels),
+        best_hp.get("units_1"),
+        best_hp.get("units_2"),
+        best_hp.get("lr"),
     )
 
     train_model.fit(
-        X_input,
-        np.array(y_label),
+        **fit_data,
         epochs=100,
-        validation_split=0.2,
         callbacks=[EarlyStopping(monitor="val_loss", patience=5)],
         verbose=0,
     )
     
-    pred_model.save(f"{outdir}/param_{param_idx+1:02d}_predictor.keras")
+    # one file per param, as loaded by infer() and validate()
+    for i, pred_model in enumerate(pred_models):
+        pred_model.save(f"{outdir}/param_{param_idx+i+1:02d}_predictor.keras")
 
 
-def train(X_input, all_y_label, outdir: str, tuning: bool):
-    args_list = []
-    for param_idx, y_label in enumerate(all_y_label):
-        args_list.append((X_input, np.array(y_label), param_idx, outdir, tuning))
-    with Pool(processes=len(all_y_label)) as pool:
-        pool.map(_train_worker_func, args_list)
+def _cpu_slots(n_models, ncpu=None):
+    """
+    Split a budget of ncpu CPUs (None means all the CPUs available to
+    the process) between the train workers, at most n_models of them
+    running at once
+    Output: list of the CPU ids of each worker running at once
+    """
+    if hasattr(os, "sched_getaffinity"):
+        available = sorted(os.sched_getaffinity(0))
+    else:
+        available = list(range(os.cpu_count()))
+    if ncpu is not None:
+        available = available[:ncpu]
+    n_workers = min(n_models, len(available))
+    return [[int(cpu) for cpu in cpus]
+            for cpus in np.array_split(available, n_workers)]
+
+
+def _init_train_worker(free_slots):
+    """
+    Initializer of the train worker processes: take a free set of CPUs
+    from _cpu_slots(), pin the worker to it and size the TF thread pools
+    to it, which is only possible before TF runs any op
+    """
+    cpus = free_slots.get()
+    _worker_state["cpus"] = cpus
+    _worker_state["free_slots"] = free_slots
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(len(cpus))
+        # the ops of a MLPR mostly depend on each other
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except RuntimeError:
+        # TF already ran in the parent process, the pinning still
+        # keeps the workers on separate CPUs
+        pass
+
+
+def _cpu_budget_worker_func(args):
+    """
+    Run _train_worker_func() in a worker from _init_train_worker(), and
+    give its CPUs back for the next worker when done
+    Return: CPU ids the MLPR was trained on
+    """
+    try:
+        _train_worker_func(args)
+    finally:
+        _worker_state["free_slots"].put(_worker_state["cpus"])
+    return _worker_state["cpus"]
+
+
+def _run_train_workers(data, all_labels, outdir, tuning, shared_trunk,
+                       pipeline=None, ncpu=None):
+    """
+    Helper function for train() and train_stream() to train the MLPRs
+    in worker processes, one per param or one for all params, within a
+    budget of ncpu CPUs (see _cpu_slots())
+    Output: CPU ids each MLPR was trained on
+    """
+    if shared_trunk:
+        # still trained in a worker to keep the graph mode of TF
+        # out of the calling process
+        args_list = [(data, all_labels, 0, outdir, tuning, pipeline)]
+    else:
+        args_list = []
+        for param_idx, labels in enumerate(all_labels):
+            args_list.append((data, [labels], param_idx, outdir, tuning,
+                              pipeline))
+    slots = _cpu_slots(len(args_list), ncpu)
+    free_slots = Queue()
+    for cpus in slots:
+        free_slots.put(cpus)
+    # one process per MLPR, since the TF thread pools of a process
+    # cannot be resized once used
+    with Pool(processes=len(slots), initializer=_init_train_worker,
+              initargs=(free_slots,), maxtasksperchild=1) as pool:
+        return pool.map(_cpu_budget_worker_func, args_list, chunksize=1)
+
+
+def train(X_input, all_y_label, outdir: str, tuning: bool,
+          shared_trunk=False, theta_range=None, batch_size=32,
+          shuffle_buffer=10000, ncpu=None):
+    """
+    Train one MLPR per dem param in parallel, or with shared_trunk=True,
+    a single MLPR for all dem params with a shared first hidden layer.
+    Either way, one prediction model per param is saved in outdir.
+    With theta_range=(min, max), the training fs are replaced by new
+    normalized Poisson samples every epoch, with theta drawn
+    log-uniformly between min and max for each fs. With normalized fs,
+    theta is the expected number of segregating sites of the samples.
+    The fs are then fed through a tf.data pipeline, in batches of
+    batch_size fs shuffled in a buffer of shuffle_buffer fs.
+    The MLPRs are trained within a budget of ncpu CPUs (None means all
+    available CPUs): if there are fewer CPUs than MLPRs, as many MLPRs
+    as CPUs are trained at once, else the CPUs are split evenly between
+    the MLPRs. Each worker is pinned to its CPUs, and its TF thread
+    pools are sized to them.
+    Output: list of the CPU ids each MLPR was trained on
+    """
+    pipeline = None
+    if theta_range is not None:
+        pipeline = {"stream": False, "batch_size": batch_size,
+                    "shuffle_buffer": shuffle_buffer,
+                    "theta_range": theta_range}
+    with tempfile.TemporaryDirectory(prefix="donni_") as tmp_dir:
+        X_fname = _shared_matrix_file(X_input, tmp_dir)
+        return _run_train_workers(X_fname, all_y_label, outdir, tuning,
+                                  shared_trunk, pipeline, ncpu)
+
+
+def train_stream(data_path, outdir: str, tuning: bool, shared_trunk=False,
+                 batch_size=32, shuffle_buffer=10000, theta_range=None,
+                 ncpu=None):
+    """
+    Version of train() streaming the training data from disk through a
+    tf.data pipeline instead of loading it into memory, so that the
+    dataset size is only limited by disk space
+    Inputs:
+        data_path: dataset dir saved in the array format or as shards
+        outdir, tuning, shared_trunk, theta_range, ncpu: same as train()
+        batch_size: number of fs in each training batch
+        shuffle_buffer: number of fs in the shuffle buffer
+    Output: list of the CPU ids each MLPR was trained on
+    """
+    _, params = load_data_chunk(data_path, data_chunks(data_path)[0])
+    pipeline = {"stream": True, "batch_size": batch_size,
+                "shuffle_buffer": shuffle_buffer, "theta_range": theta_range}
+    return _run_train_workers(data_path, list(range(params.shape[1])),
+                              outdir, tuning, shared_trunk, pipeline, ncpu)
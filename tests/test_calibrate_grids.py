@@ -0,0 +1,48 @@
+""" Tests for calibrate_grids.py """
+import numpy as np
+import pytest
+from donni.dadi_dem_models import get_model, get_param_values
+from donni.generate_data import pts_l_func
+from donni.calibrate_grids import calibrate_grids, scale_pts_l, \
+    save_grid_profile, load_grid_profile
+
+
+def test_calibrate_grids():
+    '''Test that the fastest grids meeting the tolerance are chosen'''
+
+    dem, dem_params, p_logs = get_model('two_epoch', folded=True)
+    p = get_param_values(dem_params, 4, 1)
+    chosen, results = calibrate_grids(dem, p, p_logs, [20], True,
+                                      [0.5, 1, 1.5], 0.01, ncpu=2)
+    assert [res['scale'] for res in results] == [0.5, 1, 1.5]
+    assert results[1]['pts_l'] == list(pts_l_func([20]))
+    assert results[0]['pts_l'] == list(scale_pts_l([20], 0.5))
+    # larger grids are closer to the reference grids
+    errors = [res['error'] for res in results]
+    assert errors == sorted(errors, reverse=True)
+    assert chosen['error'] <= 0.01
+    assert chosen['time'] == min(res['time'] for res in results
+                                 if res['error'] <= 0.01)
+
+    # the most accurate grids are chosen if none meet the tolerance
+    with pytest.warns(UserWarning):
+        chosen, results = calibrate_grids(dem, p, p_logs, [20], True,
+                                          [0.5, 1], 0, ncpu=2)
+    assert chosen == results[1]
+
+
+def test_grid_profile(tmp_path):
+    '''Test that calibrated grids are saved per model and sample sizes'''
+
+    profile_dir = str(tmp_path)
+    assert load_grid_profile('two_epoch', [20], profile_dir) is None
+    save_grid_profile('two_epoch', [20], {'scale': 1, 'pts_l': [24, 28, 32],
+                                          'error': 0.001, 'time': 0.1},
+                      profile_dir)
+    save_grid_profile('two_epoch', [10], {'scale': 1, 'pts_l': [13, 16, 19],
+                                          'error': 0.001, 'time': 0.1},
+                      profile_dir)
+    assert load_grid_profile('two_epoch', [20], profile_dir) == (24, 28, 32)
+    assert load_grid_profile('two_epoch', np.array([10]),
+                             profile_dir) == (13, 16, 19)
+    assert load_grid_profile('growth', [20], profile_dir) is None
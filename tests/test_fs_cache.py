@@ -0,0 +1,121 @@
+""" Tests for fs_cache.py """
+import os
+import numpy as np
+import dadi
+from donni.dadi_dem_models import get_model, get_param_values
+from donni.generate_data import generate_fs, simulate_fs
+from donni.fs_cache import fs_cache_key, load_cached_fs, save_cached_fs, \
+    evict_fs_cache
+
+
+def test_fs_cache_key():
+    '''Test that the key changes with every simulation input'''
+
+    func = dadi.Demographics1D.two_epoch
+    key = fs_cache_key(func, [1, 0.5, 0.01], [20], [40, 50, 60], False)
+    assert key == fs_cache_key(func, (1., 0.5, 0.01), (20,), (40, 50, 60),
+                               False)
+    assert key != fs_cache_key(func, [1, 0.5, 0.02], [20], [40, 50, 60],
+                               False)
+    assert key != fs_cache_key(func, [1, 0.5, 0.01], [10], [40, 50, 60],
+                               False)
+    assert key != fs_cache_key(func, [1, 0.5, 0.01], [20], [30, 40, 50],
+                               False)
+    assert key != fs_cache_key(func, [1, 0.5, 0.01], [20], [40, 50, 60],
+                               True)
+    assert key != fs_cache_key(dadi.Demographics1D.growth, [1, 0.5, 0.01],
+                               [20], [40, 50, 60], False)
+
+
+def test_simulate_fs_cached(tmp_path):
+    '''Test that a cached fs is the same as a freshly simulated fs'''
+
+    cache_dir = str(tmp_path)
+    func = dadi.Demographics1D.two_epoch
+    p = [1, 0.5, 0.01]
+    fs = simulate_fs(p, func, [20], [40, 50, 60], False, cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    cached_fs = simulate_fs(p, func, [20], [40, 50, 60], False, cache_dir)
+    np.testing.assert_array_equal(cached_fs, fs)
+
+
+def test_generate_fs_cached(tmp_path):
+    '''Test that regenerating a dataset with a different theta
+    reuses the cached simulations'''
+
+    cache_dir = str(tmp_path)
+    dem, dem_params, p_logs = get_model('two_epoch')
+    p = get_param_values(dem_params, 5, 1)
+    data, _ = generate_fs(dem, p, p_logs, 1, [20], [40, 50, 60],
+                          norm=False, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 5
+    data_1000, _ = generate_fs(dem, p, p_logs, 1000, [20], [40, 50, 60],
+                               norm=False, sampling=False,
+                               cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 5
+    for params, fs in data.items():
+        np.testing.assert_allclose(data_1000[params], 1000*fs)
+
+
+def test_generate_fs_cached_split_grids(tmp_path):
+    '''Test that split grid tasks share the cache with whole simulations'''
+
+    cache_dir = str(tmp_path)
+    dem, dem_params, p_logs = get_model('two_epoch')
+    p = get_param_values(dem_params, 3, 1)
+    data, _ = generate_fs(dem, p, p_logs, 1, [20], [40, 50, 60],
+                          cache_dir=cache_dir, split_grids=True)
+    assert len(os.listdir(cache_dir)) == 3
+    cached_data, _ = generate_fs(dem, p, p_logs, 1, [20], [40, 50, 60],
+                                 cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 3
+    for params, fs in data.items():
+        np.testing.assert_array_equal(cached_data[params], fs)
+
+
+def test_evict_fs_cache(tmp_path):
+    '''Test that the least recently used fs are evicted first'''
+
+    cache_dir = str(tmp_path)
+    fs = dadi.Spectrum(np.ones(2**16))
+    for i in range(4):
+        save_cached_fs(cache_dir, f'key_{i}', fs, 1000)
+        # distinct access times for each fs
+        os.utime(os.path.join(cache_dir, f'key_{i}.fs.pkl'), (i, i))
+    size = os.path.getsize(os.path.join(cache_dir, 'key_0.fs.pkl'))
+    # cap the cache to fit a bit more than 2 fs
+    evict_fs_cache(cache_dir, 2.5 * size / 2**20)
+    assert sorted(os.listdir(cache_dir)) == ['key_2.fs.pkl', 'key_3.fs.pkl']
+
+
+def test_evict_fs_cache_other_files(tmp_path):
+    '''Test that eviction only removes cache entries and stale
+    temporary files, and skips a missing cache dir'''
+
+    cache_dir = str(tmp_path)
+    fs = dadi.Spectrum(np.ones(2**16))
+    save_cached_fs(cache_dir, 'key_0', fs, 1000)
+    # files that are not cache entries, even old ones, must survive
+    for fname in ['data.pkl', 'notes.tmp', 'key_1.fs.pkl.123.tmp']:
+        with open(os.path.join(cache_dir, fname), 'wb') as fh:
+            fh.write(bytes(2**20))
+        os.utime(os.path.join(cache_dir, fname), (0, 0))
+    # temporary file of a killed process that is still being written
+    with open(os.path.join(cache_dir, 'key_2.fs.pkl.456.tmp'), 'wb') as fh:
+        fh.write(bytes(10))
+    evict_fs_cache(cache_dir, 0)
+    assert sorted(os.listdir(cache_dir)) == [
+        'data.pkl', 'key_2.fs.pkl.456.tmp', 'notes.tmp']
+
+    evict_fs_cache(str(tmp_path / 'missing'), 0)
+    assert not os.path.exists(tmp_path / 'missing')
+
+
+def test_load_cached_fs_missing(tmp_path):
+    '''Test that a missing fs is a cache miss'''
+
+    assert load_cached_fs(str(tmp_path), 'key_0') is None
+    fs = dadi.Spectrum(np.ones(10))
+    save_cached_fs(str(tmp_path), 'key_0', fs, 1000)
+    np.testing.assert_array_equal(load_cached_fs(str(tmp_path), 'key_0'),
+                                  fs)
@@ -1,11 +1,24 @@
 """ Tests for generate_data.py and dadi_dem_models.py"""
 import os
+import time
 import random
+from multiprocessing import Pool
 import numpy as np
 import pytest
 import dadi
-from donni.dadi_dem_models import get_model, get_param_values
-from donni.generate_data import generate_fs
+from donni import generate_data
+from donni.dadi_dem_models import get_model, get_param_values, \
+    add_misid_values, sample_param_values
+from donni.generate_data import generate_fs, generate_fs_shards, \
+    generate_fs_variants, load_data, get_bootstrap_fs, save_array_data, \
+    load_array_data, is_array_data, save_individual_fs, load_individual_fs, \
+    export_individual_fs, simulate_fs, simulate_fs_split_grids, \
+    data_chunks, load_data_chunk, \
+    fs_quality_check, refine_pts_l, \
+    FS_OK, FS_FAILED, FS_TIMED_OUT, NEG_FS_THRESHOLD, \
+    _check_fs, _postprocess_fs, _fs_rng, _sample_fs, _init_worker, \
+    _worker_simulate_fs, _chunksize, _cost_chunks, _imap_longest_first, \
+    _n_processes, estimate_task_mem
 
 
 def run(model_name, sample_size, theta, n_samples,
@@ -137,12 +150,18 @@ def run_bootstrap(model_name, sample_size, theta, n_samples, n_bstr):
     # check that the first value is a fs
     assert all(isinstance(fs, dadi.Spectrum_mod.Spectrum) for fs in all_fs)
 
-    for bstr in all_bstr_fs:
-        # check that the second value is a list of the correct length
-        assert isinstance(bstr, list) and len(bstr) == n_bstr
+    for fs, bstr in zip(all_fs, all_bstr_fs):
+        # check that the second value is an array of bootstrap counts
+        assert isinstance(bstr, np.ndarray)
+        assert bstr.shape == (n_bstr,) + fs.shape
+        assert np.issubdtype(bstr.dtype, np.unsignedinteger)
 
-        # check that this list contains fs objects
-        assert all(isinstance(fs, dadi.Spectrum_mod.Spectrum) for fs in bstr)
+        # check that it unpacks to a list of fs objects
+        bstr_fs = get_bootstrap_fs(fs, bstr)
+        assert len(bstr_fs) == n_bstr
+        assert all(isinstance(b_fs, dadi.Spectrum_mod.Spectrum)
+                   for b_fs in bstr_fs)
+        assert all(np.array_equal(b_fs.mask, fs.mask) for b_fs in bstr_fs)
 
 
 def test_run_bstr_theta_1():
@@ -157,6 +176,42 @@ def test_run_bstr_theta_1():
                     20], grids, bootstrap=True, n_bstr=10)
 
 
+def test_run_bstr_theta_1_parent(tmp_path):
+    '''Test that bootstrap with theta = 1 is rejected before starting
+    the pool, for any dataset variant and for streamed shards'''
+    grids = [40, 50, 60]
+
+    dem, dem_params, p_logs = get_model('two_epoch')
+    p = get_param_values(dem_params, 5)
+    variants = [{"theta": 1000, "norm": True, "sampling": True,
+                 "folded": False, "bootstrap": False, "n_bstr": 10},
+                {"theta": 1, "norm": True, "sampling": True,
+                 "folded": False, "bootstrap": True, "n_bstr": 10}]
+    with pytest.raises(SystemExit):
+        generate_fs_variants(dem, p, p_logs, [20], grids, variants)
+    with pytest.raises(SystemExit):
+        generate_fs_shards(dem, p, p_logs, 1, [20], grids,
+                           str(tmp_path / 'shards'), bootstrap=True)
+    # nothing is written when the run is rejected
+    assert not os.path.exists(tmp_path / 'shards')
+
+
+def test_bootstrap_fs_vectorized():
+    '''Test that the bootstrap fs drawn in one call are the same as
+    bootstrap fs sampled one by one from the same random generator'''
+
+    fs = dadi.Demographics1D.two_epoch((2, 0.1), [20], 60)
+    fs_tostore, bstr = _postprocess_fs(fs, 1000, True, True, False, True,
+                                       20, _fs_rng(5, 0))
+    rng = _fs_rng(5, 0)
+    expected_fs = _sample_fs(1000*fs, rng)
+    np.testing.assert_array_equal(fs_tostore, expected_fs)
+    for i, b_fs in enumerate(get_bootstrap_fs(fs_tostore, bstr)):
+        np.testing.assert_array_equal(b_fs, _sample_fs(expected_fs, rng))
+        np.testing.assert_array_equal(
+            b_fs, get_bootstrap_fs(fs_tostore, bstr, i))
+
+
 def test_run_two_epoch_bstr():
     '''Generate 10 bootstrap datasets (theta=1000) for 5 FS datasets
     of the two_epoch model with one population sample size 20'''
@@ -171,6 +226,147 @@ def test_run_split_mig_bstr():
     run_bootstrap('split_mig', [20, 20], 100, 3, 5)
 
 
+def test_run_shards(tmp_path):
+    '''Stream 5 FS of the two_epoch model to shards of at most 2 FS'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('two_epoch')
+    p = get_param_values(dem_params, 5)
+    outdir = str(tmp_path / 'shards')
+    qual = generate_fs_shards(dem, p, p_logs, 1000, [20], grids, outdir,
+                              shard_size=2)
+
+    # check that 3 shards were written and one quality stat per FS
+    shards = [f for f in os.listdir(outdir) if f.startswith('shard_')]
+    assert sorted(shards) == ['shard_00000', 'shard_00001', 'shard_00002']
+    assert qual.shape == (5, 9)
+    # check the stats against those of a non-streamed run
+    _, expected_qual = generate_fs(dem, p, p_logs, 1000, [20], grids)
+    np.testing.assert_array_equal(qual, expected_qual)
+
+    # check that the shards load back into one dataset dict
+    data = load_data(outdir)
+    assert set(data.keys()) == set(p)
+    assert all(isinstance(fs, dadi.Spectrum_mod.Spectrum)
+               for fs in data.values())
+    np.testing.assert_allclose([fs.sum() for fs in data.values()], 1.)
+
+
+def test_run_shards_resume(tmp_path):
+    '''Test that resuming an interrupted run gives the same dataset
+    as an uninterrupted run with the same seed'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('two_epoch')
+    p = get_param_values(dem_params, 5, 1)
+    data, qual = generate_fs(dem, p, p_logs, 1000, [20], grids, seed=1)
+
+    outdir = str(tmp_path / 'shards')
+    generate_fs_shards(dem, p, p_logs, 1000, [20], grids, outdir,
+                       shard_size=2, seed=1)
+    # simulate an interruption by removing the last completed shard
+    os.remove(os.path.join(outdir, 'shard_00002'))
+    resumed_qual = generate_fs_shards(dem, p, p_logs, 1000, [20], grids,
+                                      outdir, shard_size=2, seed=1,
+                                      resume=True)
+
+    resumed_data = load_data(outdir)
+    assert set(resumed_data.keys()) == set(data.keys())
+    for params, fs in data.items():
+        np.testing.assert_array_equal(resumed_data[params], fs)
+    np.testing.assert_array_equal(resumed_qual, qual)
+
+    # check that resuming with different settings is refused
+    with pytest.raises(SystemExit):
+        generate_fs_shards(dem, p, p_logs, 100, [20], grids, outdir,
+                           shard_size=2, seed=1, resume=True)
+
+
+def test_run_variants():
+    '''Generate a training, test and folded dataset from the same
+    simulated FS of the split_mig model'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('split_mig')
+    p = get_param_values(dem_params, 3)
+    variants = [dict(theta=1, norm=True, sampling=True, folded=False,
+                     bootstrap=False, n_bstr=200),
+                dict(theta=1000, norm=False, sampling=False, folded=False,
+                     bootstrap=False, n_bstr=200),
+                dict(theta=1, norm=True, sampling=True, folded=True,
+                     bootstrap=False, n_bstr=200)]
+    (train, test, folded), qual = generate_fs_variants(
+        dem, p, p_logs, [10, 10], grids, variants)
+
+    assert len(qual) == 3
+    assert list(train.keys()) == list(test.keys())
+    # folded params exclude misid, which folding cancels out
+    assert list(folded.keys()) == [params[:-1] for params in train]
+    for params, fs in train.items():
+        np.testing.assert_allclose(test[params] / test[params].sum(), fs)
+        assert folded[params[:-1]].folded
+        np.testing.assert_allclose(folded[params[:-1]], fs.fold())
+
+    # unfolded variants need the misid param
+    with pytest.raises(ValueError):
+        generate_fs_variants(dem, p, p_logs, [10, 10], grids, variants,
+                             folded=True)
+
+
+def test_run_variants_projection():
+    '''Test that FS projected from a larger sample size match FS
+    simulated at the smaller sample size with the same grids'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('split_mig')
+    p = get_param_values(dem_params, 3)
+    variants = [dict(theta=1, norm=True, sampling=True, folded=False,
+                     bootstrap=False, n_bstr=200, ns=ns)
+                for ns in [[20, 20], [10, 10], [10, 20]]]
+    data_list, _ = generate_fs_variants(dem, p, p_logs, [20, 20], grids,
+                                        variants)
+    for data, ns in zip(data_list, [[20, 20], [10, 10], [10, 20]]):
+        expected, _ = generate_fs(dem, p, p_logs, 1, ns, grids)
+        for params, fs in data.items():
+            assert fs.sample_sizes.tolist() == ns
+            np.testing.assert_allclose(fs, expected[params], rtol=1e-5)
+
+    # cannot project to larger sample sizes
+    with pytest.raises(ValueError):
+        generate_fs_variants(dem, p, p_logs, [10, 10], grids, variants)
+
+
+def test_run_misid_augmentation(tmp_path):
+    '''Test that FS with misid applied after simulation match FS
+    simulated with misid, and that misid values share one simulation'''
+
+    grids = [40, 50, 60]
+    cache_dir = str(tmp_path)
+    dem, dem_params, p_logs = get_model('two_epoch')
+    p = add_misid_values(get_param_values(dem_params, 3), 4)
+    assert len(p) == 12
+    assert all(params[:-1] == p[0][:-1] for params in p[:4])
+
+    variant = dict(theta=1, norm=False, sampling=True, folded=False,
+                   bootstrap=False, n_bstr=200)
+    (data,), qual = generate_fs_variants(dem, p, p_logs, [20], grids,
+                                         [variant], cache_dir=cache_dir,
+                                         post_misid=True)
+    # one misid-free simulation per param set
+    assert len(os.listdir(cache_dir)) == 3
+    assert len(data) == len(qual) == 12
+
+    expected, _ = generate_fs(dem, p, p_logs, 1, [20], grids, norm=False)
+    for params, fs in data.items():
+        np.testing.assert_allclose(fs, expected[params], rtol=1e-6)
+
+    # folded fs of param sets only differing in misid would be duplicates
+    with pytest.raises(ValueError):
+        generate_fs_variants(dem, p, p_logs, [20], grids,
+                             [variant, dict(variant, folded=True)],
+                             post_misid=True)
+
+
 def run_seed(param_names, n_samples, s_pair):
     '''Template method for testing if seeding is working correctly
     for generating reproducible parameter set'''
@@ -190,6 +386,39 @@ def run_seed(param_names, n_samples, s_pair):
         assert all(p not in p_2 for p in p_1)
 
 
+@pytest.mark.parametrize('method', ['random', 'sobol', 'lhs'])
+def test_sample_param_values(method):
+    '''Test that param values are sampled within their ranges and
+    that the T params sum to at most the T range'''
+
+    param_names = ['nu1', 'nu2', 'T1', 'T2', 'T3', 'm', 's', 'misid']
+    values = sample_param_values(param_names, 256, 1, method)
+    assert values.shape == (256, 8)
+    np.testing.assert_array_equal(
+        values, sample_param_values(param_names, 256, 1, method))
+    assert np.all((values[:, :2] >= -2) & (values[:, :2] < 2))
+    assert np.all(values[:, 2:5] >= 0)
+    t_sum = values[:, 2:5].sum(axis=1)
+    assert np.all((t_sum >= 0.01) & (t_sum < 2))
+    assert np.all((values[:, 5] >= 0) & (values[:, 5] < 10))
+    assert np.all((values[:, 6] >= 0.01) & (values[:, 6] < 0.99))
+    assert np.all((values[:, 7] >= 0) & (values[:, 7] < 0.25))
+    # the T params are exchangeable fractions of their sum
+    np.testing.assert_allclose(
+        (values[:, 2:5] / t_sum[:, None]).mean(axis=0), 1/3, atol=0.05)
+
+    p = get_param_values(param_names, 256, 1, method)
+    assert p == [tuple(v) for v in values.tolist()]
+    assert all(isinstance(v, float) for v in p[0])
+
+
+def test_sample_param_values_unknown():
+    '''Test that an unknown sampling method is rejected'''
+
+    with pytest.raises(ValueError):
+        sample_param_values(['nu', 'T'], 10, method='grid')
+
+
 def test_run_seed_1():
     '''Test if similar seed pair is the same'''
 
@@ -204,3 +433,449 @@ def test_run_seed_2():
     param_names = ['nu', 'T', 'm', 'misid']
     run_seed(param_names, 40, (1, 5))
     run_seed(param_names, 20, (3, 4))
+
+
+def test_array_data(tmp_path):
+    '''Test saving a dataset in the array format and loading it back'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('split_mig', folded=True)
+    p = get_param_values(dem_params, 5)
+    data, _ = generate_fs(dem, p, p_logs, 1000, [10, 8], grids, folded=True)
+    outdir = str(tmp_path / 'data')
+    save_array_data(data, outdir, {'model': 'split_mig', 'logs': p_logs})
+    assert is_array_data(outdir) and not is_array_data(str(tmp_path))
+
+    X, params, mask, metadata = load_array_data(outdir)
+    assert isinstance(X, np.memmap) and X.dtype == np.float32
+    assert X.shape == (5, 11 * 9)
+    np.testing.assert_array_equal(params, p)
+    assert metadata['version'] == 2 and metadata['shape'] == [11, 9]
+    assert not metadata['counts']
+    assert metadata['folded'] and metadata['logs'] == p_logs
+    for x, fs in zip(X, data.values()):
+        np.testing.assert_array_equal(mask, fs.mask)
+        np.testing.assert_allclose(x, np.ma.filled(fs, 0).ravel(),
+                                   rtol=1e-6)
+
+    # the array format loads back to the same data dict
+    loaded = load_data(outdir)
+    assert list(loaded.keys()) == list(data.keys())
+    for params, fs in data.items():
+        assert loaded[params].folded
+        np.testing.assert_allclose(loaded[params], fs, rtol=1e-6)
+
+    # bootstrap data does not fit in a matrix
+    bstr_data, _ = generate_fs(dem, p[:2], p_logs, 1000, [10, 8], grids,
+                               folded=True, bootstrap=True, n_bstr=2)
+    with pytest.raises(ValueError):
+        save_array_data(bstr_data, str(tmp_path / 'bstr'), {})
+
+
+def test_array_data_counts(tmp_path):
+    '''Test saving sampled fs as counts and normalizing them when loaded'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('two_epoch')
+    p = get_param_values(dem_params, 5)
+    data, _ = generate_fs(dem, p, p_logs, 100000, [20], grids, norm=False)
+    outdir = str(tmp_path / 'data')
+    save_array_data(data, outdir, {'norm': True}, counts=True)
+
+    counts, _, _, metadata = load_array_data(outdir, raw_counts=True)
+    assert metadata['counts'] and counts.dtype in [np.uint16, np.uint32]
+    X, params, _, _ = load_array_data(outdir)
+    assert X.dtype == np.float32
+    for x, c, fs in zip(X, counts, data.values()):
+        np.testing.assert_array_equal(c, np.ma.filled(fs, 0))
+        np.testing.assert_allclose(x, np.ma.filled(fs/fs.sum(), 0),
+                                   rtol=1e-6)
+    # the dataset loads back as normalized fs
+    for params, fs in load_data(outdir).items():
+        np.testing.assert_allclose(fs, data[params]/data[params].sum(),
+                                   rtol=1e-6)
+
+    # only sampled fs can be stored as counts
+    norm_data, _ = generate_fs(dem, p, p_logs, 1000, [20], grids)
+    with pytest.raises(ValueError):
+        save_array_data(norm_data, str(tmp_path / 'norm'), {'norm': True},
+                        counts=True)
+
+
+def test_data_chunks(tmp_path):
+    '''Test loading datasets in the array format and as shards in chunks'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('two_epoch')
+    p = get_param_values(dem_params, 5)
+    data, _ = generate_fs(dem, p, p_logs, 100000, [20], grids, norm=False)
+    save_array_data(data, str(tmp_path / 'counts'), {'norm': True},
+                    counts=True)
+    generate_fs_shards(dem, p, p_logs, 1000, [20], grids,
+                       str(tmp_path / 'shards'), shard_size=2)
+
+    X, params, _, _ = load_array_data(str(tmp_path / 'counts'))
+    chunks = data_chunks(str(tmp_path / 'counts'), chunk_size=2)
+    assert chunks == [('X.npy', 0, 2), ('X.npy', 2, 4), ('X.npy', 4, 5)]
+    loaded = [load_data_chunk(str(tmp_path / 'counts'), chunk)
+              for chunk in chunks]
+    np.testing.assert_array_equal(np.concatenate([x for x, _ in loaded]), X)
+    np.testing.assert_array_equal(np.concatenate([y for _, y in loaded]),
+                                  params)
+
+    chunks = data_chunks(str(tmp_path / 'shards'))
+    assert [chunk[2] for chunk in chunks] == [2, 2, 1]
+    shard_data = load_data(str(tmp_path / 'shards'))
+    for chunk in chunks:
+        X, params = load_data_chunk(str(tmp_path / 'shards'), chunk)
+        assert X.dtype == np.float32 and len(X) == len(params) == chunk[2]
+        for x, params in zip(X, params):
+            np.testing.assert_allclose(x, shard_data[tuple(params)].flatten(),
+                                       rtol=1e-6)
+    with pytest.raises(ValueError):
+        data_chunks(str(tmp_path / 'missing'))
+
+
+def test_individual_fs(tmp_path):
+    '''Test saving fs to one container and reading them back by index'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('split_mig')
+    p = get_param_values(dem_params, 4)
+    data, _ = generate_fs(dem, p, p_logs, 1000, [10, 8], grids)
+    # one folded fs to check that masks and folding are kept
+    data[p[1]] = data[p[1]].fold()
+    outdir = str(tmp_path / 'fs')
+    save_individual_fs(data, outdir)
+    assert sorted(os.listdir(outdir)) == [
+        'fs_data.bin', 'fs_index.npy', 'fs_mask.bin', 'true_log_params']
+    true_log_params = load_data(os.path.join(outdir, 'true_log_params'))
+    assert true_log_params == p
+
+    fs = load_individual_fs(outdir, 1)
+    assert fs.folded and fs.shape == (11, 9)
+    np.testing.assert_array_equal(fs.mask, data[p[1]].mask)
+    np.testing.assert_array_equal(fs, data[p[1]])
+    all_fs = load_individual_fs(outdir)
+    assert len(all_fs) == 4
+    for fs, expected_fs in zip(all_fs, data.values()):
+        np.testing.assert_array_equal(fs, expected_fs)
+        assert fs.folded == expected_fs.folded
+
+    # dadi fs files are only written when exported
+    export_individual_fs(outdir, str(tmp_path / 'dadi'), [0, 2])
+    assert sorted(os.listdir(tmp_path / 'dadi')) == ['fs_000', 'fs_002']
+    np.testing.assert_allclose(
+        dadi.Spectrum.from_file(str(tmp_path / 'dadi' / 'fs_002')),
+        data[p[2]])
+
+
+def test_check_fs():
+    '''Test the quality check stats on a fs with negative, NaN and
+    inf entries against a check on the masked array'''
+
+    fs = dadi.Spectrum(np.arange(36.).reshape(6, 6) - 3)
+    fs[2, 3] = -0.5
+    fs[3, 1] = np.nan
+    fs[4, 4] = np.inf
+    fs_ma = fs.copy()
+    fs_ma.flat[0] = 0
+    fs_ma.flat[-1] = 0
+    with np.errstate(invalid='ignore'):
+        expected = [(fs_ma < 0).sum(), np.isnan(fs_ma).sum(),
+                    np.isposinf(fs_ma).sum(), fs_ma.min(),
+                    np.sum(fs_ma[fs_ma < 0]), fs_ma.sum(),
+                    abs(np.sum(fs_ma[fs_ma < 0])/fs_ma.sum()), FS_OK, 0]
+        checked_fs, fs_qual = _check_fs(fs)
+    assert isinstance(fs_qual, np.ndarray) and fs_qual.shape == (9,)
+    np.testing.assert_array_equal(fs_qual, expected)
+    assert list(fs_qual[:3]) == [3, 1, 1]
+    np.testing.assert_array_equal(checked_fs, abs(fs_ma))
+
+    # only zero stats for a fs without negative entries
+    _, fs_qual = _check_fs(dadi.Spectrum(np.arange(1., 11.)))
+    np.testing.assert_array_equal(fs_qual, np.zeros(9))
+
+
+def test_run_worker_postprocess():
+    '''Test that post-processing in the workers gives the same fs and
+    quality stats as post-processing each fs in the main process'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('split_mig')
+    p = get_param_values(dem_params, 4, seed=3)
+    data, qual = generate_fs(dem, p, p_logs, 1000, [10, 10], grids,
+                             seed=11, ncpu=2)
+    # the output for a fixed seed does not depend on the number of CPUs
+    data_1, qual_1 = generate_fs(dem, p, p_logs, 1000, [10, 10], grids,
+                                 seed=11, ncpu=1)
+    assert qual.shape == (4, 9)
+    np.testing.assert_array_equal(qual, qual_1)
+    for idx, params in enumerate(p):
+        delog_p = [10**params[i] if p_logs[i] else params[i]
+                   for i in range(len(p_logs))]
+        fs, fs_qual = _check_fs(simulate_fs(delog_p, dem, [10, 10],
+                                            grids, False))
+        expected_fs = _postprocess_fs(fs, 1000, True, True, False, False,
+                                      200, _fs_rng(11, idx))
+        np.testing.assert_array_equal(qual[idx], fs_qual)
+        np.testing.assert_array_equal(data[params], expected_fs)
+        np.testing.assert_array_equal(data_1[params], expected_fs)
+        # fs written to the shared output matrix keep their mask
+        np.testing.assert_array_equal(data[params].mask, expected_fs.mask)
+
+
+def test_run_variants_shared_output():
+    '''Test that fs sent back through the shared output matrices keep
+    their mask and folding, alongside bootstrap data sent back whole'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('split_mig')
+    p = get_param_values(dem_params, 3, seed=2)
+    variants = [dict(theta=1, norm=True, sampling=True, folded=False,
+                     bootstrap=False, n_bstr=5),
+                dict(theta=1000, norm=False, sampling=True, folded=True,
+                     bootstrap=False, n_bstr=5, ns=[8, 6]),
+                dict(theta=1000, norm=True, sampling=True, folded=False,
+                     bootstrap=True, n_bstr=5)]
+    data_list, _ = generate_fs_variants(dem, p, p_logs, [10, 8], grids,
+                                        variants, seed=4)
+    for idx, params in enumerate(p):
+        delog_p = [10**params[i] if p_logs[i] else params[i]
+                   for i in range(len(p_logs))]
+        sim_fs = simulate_fs(delog_p, dem, [10, 8], grids, False)
+        fs, _ = _check_fs(sim_fs.project([8, 6]))
+        expected_fs = _postprocess_fs(fs, 1000, False, True, True, False, 5,
+                                      _fs_rng(4, idx, 1))
+        folded_fs = data_list[1][tuple(params[:-1])]
+        assert folded_fs.folded and folded_fs.shape == (9, 7)
+        np.testing.assert_array_equal(folded_fs.mask, expected_fs.mask)
+        np.testing.assert_array_equal(folded_fs, expected_fs)
+        assert not data_list[0][params].folded
+        assert isinstance(data_list[2][params], list)
+
+
+def test_init_worker():
+    '''Test that a worker set up once by the pool initializer simulates
+    the same fs as wrapping the model for each simulation'''
+
+    dem, dem_params, p_logs = get_model('two_epoch')
+    _init_worker(dem, [20], [40, 50, 60], False, None, 10000, None, 0, None)
+    for p in [[1, 0.5, 0.01], [0.1, 0.2, 0.03]]:
+        np.testing.assert_array_equal(
+            _worker_simulate_fs(p),
+            simulate_fs(p, dem, [20], [40, 50, 60], False))
+    # tasks are batched as with Pool.map()
+    assert _chunksize(1, 4) == 1
+    assert _chunksize(160, 4) == 10
+    assert _chunksize(161, 4) == 11
+
+
+def flaky_two_epoch(params, ns, pts):
+    '''two_epoch model failing for nu < 0 and hanging for nu > 100'''
+    nu, T = params
+    if nu < 0:
+        raise ValueError("nu < 0")
+    if nu > 100:
+        time.sleep(60)
+    return dadi.Demographics1D.two_epoch(params, ns, pts)
+
+
+flaky_two_epoch.__param_names__ = ['nu', 'T']
+
+
+@pytest.mark.parametrize("variants", [False, True])
+def test_run_failed_fs(tmp_path, variants):
+    '''Test that param sets whose simulation fails or times out are left
+    out of the dataset without stopping the run'''
+
+    grids = [40, 50, 60]
+    p = [(1, 0.5), (-1, 0.5), (200, 0.5), (2, 0.1)]
+    start = time.time()
+    if variants:
+        variant = {"theta": 1000, "norm": True, "sampling": True,
+                   "folded": True, "bootstrap": False, "n_bstr": 200}
+        data_list, qual = generate_fs_variants(
+            flaky_two_epoch, p, [False, False], [20], grids,
+            [variant, dict(variant, norm=False)], folded=True, ncpu=2,
+            timeout=2)
+        data = data_list[1]
+    else:
+        data, qual = generate_fs(flaky_two_epoch, p, [False, False], 1000,
+                                 [20], grids, folded=True, ncpu=2, timeout=2)
+    # the hanging simulation is stopped at the timeout
+    assert time.time() - start < 30
+    assert set(data.keys()) == {(1, 0.5), (2, 0.1)}
+    np.testing.assert_array_equal(
+        qual[:, 7], [FS_OK, FS_FAILED, FS_TIMED_OUT, FS_OK])
+
+    filename = str(tmp_path / 'data')
+    fs_quality_check(qual, filename, p, ['nu', 'T'], [False, False])
+    with open(f'{filename}_quality.txt') as fh:
+        report = fh.read()
+    assert 'Number of FS whose simulation failed: 1' in report
+    assert 'Number of FS whose simulation timed out: 1' in report
+    assert 'FS 2 (timed out):' in report
+
+
+def test_run_shards_failed_fs(tmp_path):
+    '''Test that failed fs are recorded in the progress of a streamed
+    run but left out of its shards'''
+
+    grids = [40, 50, 60]
+    p = [(1, 0.5), (-1, 0.5), (2, 0.1)]
+    outdir = str(tmp_path / 'shards')
+    qual = generate_fs_shards(flaky_two_epoch, p, [False, False], 1000,
+                              [20], grids, outdir, shard_size=2, folded=True,
+                              seed=1)
+    np.testing.assert_array_equal(qual[:, 7], [FS_OK, FS_FAILED, FS_OK])
+    assert set(load_data(outdir).keys()) == {(1, 0.5), (2, 0.1)}
+    # resuming does not simulate the failed fs again
+    qual = generate_fs_shards(flaky_two_epoch, p, [False, False], 1000,
+                              [20], grids, outdir, shard_size=2, folded=True,
+                              seed=1, resume=True)
+    np.testing.assert_array_equal(qual[:, 7], [FS_OK, FS_FAILED, FS_OK])
+
+
+def coarse_two_epoch(params, ns, pts):
+    '''two_epoch model with a negative entry on grids smaller than 58
+    for nu > 1'''
+    fs = dadi.Demographics1D.two_epoch(params, ns, pts)
+    if params[0] > 1 and pts < 58:
+        fs[2] = -0.01 * fs.sum()
+    return fs
+
+
+coarse_two_epoch.__param_names__ = ['nu', 'T']
+
+
+def test_run_refine_grids(tmp_path):
+    '''Test that only the fs failing the quality check are re-simulated
+    on larger grids'''
+
+    grids = [40, 50, 55]
+    p = [(0.5, 0.5), (2, 0.5), (0.2, 0.1)]
+    data, qual = generate_fs(coarse_two_epoch, p, [False, False], 1, [20],
+                             grids, folded=True, ncpu=2)
+    np.testing.assert_array_equal(qual[:, 8], [0, 1, 0])
+    assert np.all(qual[:, 6] <= NEG_FS_THRESHOLD)
+    assert refine_pts_l(grids, 1) == (60, 75, 82)
+    for params, level in zip(p, qual[:, 8]):
+        fs, _ = _check_fs(simulate_fs(params, coarse_two_epoch, [20],
+                                      refine_pts_l(grids, int(level)), True))
+        expected_fs = _postprocess_fs(fs, 1, True, True, True, False, 200,
+                                      None)
+        np.testing.assert_array_equal(data[params], expected_fs)
+
+    # without refinement, the fs is kept on the default grids and reported
+    _, qual = generate_fs(coarse_two_epoch, p, [False, False], 1, [20],
+                          grids, folded=True, ncpu=2, refine_grids=0)
+    assert not qual[:, 8].any() and qual[1, 6] > NEG_FS_THRESHOLD
+    filename = str(tmp_path / 'data')
+    fs_quality_check(qual, filename, p, ['nu', 'T'], [False, False], grids)
+    with open(f'{filename}_quality.txt') as fh:
+        assert 'Grid sizes: (40, 50, 55)' in fh.read()
+
+
+def sleep_task(seconds):
+    '''Task taking seconds to run'''
+    time.sleep(seconds)
+    return seconds
+
+
+def test_imap_longest_first():
+    '''Test that tasks after the pilot are sent longest-first, in chunks
+    with a decreasing cost'''
+
+    cost = np.array([8., 1, 1, 1, 4, 2, 1, 1])
+    chunks = _cost_chunks(np.argsort(-cost, kind='stable'), cost, 1)
+    assert chunks == [[0], [4], [5], [1], [2], [3], [6], [7]]
+    # cheap tasks are batched
+    chunks = _cost_chunks(np.array([1, 2, 3, 6]), cost, 0.5)
+    assert chunks == [[1, 2], [3], [6]]
+
+    tasks = [0.01, 0.02, 0.05, 0.001, 0.03, 0.001, 0.04, 0.02, 0.06, 0.001]
+    with Pool(processes=1) as pool:
+        outputs = list(_imap_longest_first(pool, sleep_task, tasks,
+                                           np.array(tasks)[:, None], 1))
+    # the pilot runs first, then the slowest tasks
+    assert outputs[:2] == tasks[:2]
+    assert outputs[2:] == sorted(tasks[2:], reverse=True)
+
+
+def test_run_split_grids():
+    '''Test that simulating each grid size as a separate task gives the
+    same fs as extrapolating in the worker'''
+
+    grids = [40, 50, 60]
+    dem, dem_params, p_logs = get_model('split_mig')
+    p = [1.2, 0.8, 0.3, 2.0, 0.02]
+    np.testing.assert_array_equal(
+        simulate_fs_split_grids(p, dem, [10, 10], grids, False),
+        simulate_fs(p, dem, [10, 10], grids, False))
+
+    p = add_misid_values(get_param_values(dem_params, 3, seed=2), 2, 2)
+    variants = [{"theta": 1000, "norm": True, "sampling": True,
+                 "folded": False, "bootstrap": False, "n_bstr": 200}]
+    expected, expected_qual = generate_fs_variants(
+        dem, p, p_logs, [10, 10], grids, variants, seed=3, post_misid=True)
+    data, qual = generate_fs_variants(
+        dem, p, p_logs, [10, 10], grids, variants, seed=3, post_misid=True,
+        split_grids=True)
+    np.testing.assert_array_equal(qual, expected_qual)
+    for params in p:
+        np.testing.assert_array_equal(data[0][params], expected[0][params])
+
+
+def test_run_split_grids_refine_failed():
+    '''Test grid refinement and failed fs with split grid tasks'''
+
+    p = [(0.5, 0.5), (2, 0.5), (-1, 0.1)]
+    expected, expected_qual = generate_fs(
+        coarse_two_epoch, p[:2], [False, False], 1, [20], [40, 50, 55],
+        folded=True)
+    data, qual = generate_fs(coarse_two_epoch, p[:2], [False, False], 1,
+                             [20], [40, 50, 55], folded=True,
+                             split_grids=True)
+    np.testing.assert_array_equal(qual, expected_qual)
+    assert qual[1, 8] == 1
+    for params in p[:2]:
+        np.testing.assert_array_equal(data[params], expected[params])
+
+    data, qual = generate_fs(flaky_two_epoch, p, [False, False], 1, [20],
+                             [40, 50, 60], folded=True, split_grids=True)
+    assert set(data.keys()) == set(p[:2])
+    np.testing.assert_array_equal(qual[:, 7], [FS_OK, FS_OK, FS_FAILED])
+
+
+def test_max_mem(monkeypatch):
+    '''Test that the number of workers is capped by the memory budget'''
+
+    # the phi of 3D models dominates the memory of a simulation
+    assert estimate_task_mem([20, 20, 20], [54, 63, 72]) > \
+        estimate_task_mem([20, 20], [54, 63, 72]) > \
+        estimate_task_mem([20], [54, 63, 72])
+    task_mem = estimate_task_mem([20, 20, 20], [54, 63, 72])
+    assert _n_processes(8, None, [20, 20, 20], [54, 63, 72], 0) == 8
+    assert _n_processes(8, 3 * task_mem, [20, 20, 20], [54, 63, 72], 0) == 3
+    # memory is reserved for one simulation on refined grids
+    refined_mem = estimate_task_mem([20, 20, 20], [81, 94, 108])
+    assert _n_processes(8, refined_mem + 2 * task_mem, [20, 20, 20],
+                        [54, 63, 72], 1) == 3
+    # at least one worker
+    assert _n_processes(8, 1, [20, 20, 20], [54, 63, 72], 0) == 1
+
+    dem, dem_params, p_logs = get_model('two_epoch')
+    p = get_param_values(dem_params, 3, 1)
+    expected, _ = generate_fs(dem, p, p_logs, 1000, [20], [40, 50, 60],
+                              seed=1)
+    data, _ = generate_fs(dem, p, p_logs, 1000, [20], [40, 50, 60], seed=1,
+                          max_mem=1)
+    for params in p:
+        np.testing.assert_array_equal(data[params], expected[params])
+    # workers replaced after each task are set up again
+    monkeypatch.setattr(generate_data, 'MAX_TASKS_PER_CHILD', 1)
+    data, _ = generate_fs(dem, p, p_logs, 1000, [20], [40, 50, 60], seed=1,
+                          ncpu=2)
+    for params in p:
+        np.testing.assert_array_equal(data[params], expected[params])
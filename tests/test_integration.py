@@ -6,8 +6,10 @@ import re
 import random
 import string
 from subprocess import getstatusoutput, getoutput
+import json
 import pickle
 import shutil
+import numpy as np
 
 PRG = 'donni'
 
@@ -104,6 +106,168 @@ def test_run_generate_data_bstr():
     run_generate_data_sub(args, args_expected)
 
 
+def test_run_generate_data_extra_output():
+    '''Generate a training and a test dataset in one run'''
+
+    outfile = random_string()
+    test_outfile = random_string()
+    try:
+        rv, _ = getstatusoutput(
+            f'{PRG} generate_data --model two_epoch --n_samples 5'
+            f' --sample_sizes 10 --outfile {outfile}'
+            f' --extra_output {test_outfile} theta=1000')
+        assert rv == 0
+        data = pickle.load(open(outfile, 'rb'))
+        test_data = pickle.load(open(test_outfile, 'rb'))
+        assert list(data.keys()) == list(test_data.keys())
+
+    finally:  # remove output files
+        for fname in [outfile, test_outfile, f'{outfile}_quality.txt']:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+
+def test_run_generate_data_array_format():
+    '''Generate a training and a folded test dataset in the array format'''
+
+    outdir = random_string()
+    test_outdir = random_string()
+    try:
+        rv, _ = getstatusoutput(
+            f'{PRG} generate_data --model two_epoch --n_samples 5'
+            f' --sample_sizes 10 --outfile {outdir} --data_format array'
+            f' --extra_output {test_outdir} theta=1000 folded=true')
+        assert rv == 0
+        assert sorted(os.listdir(outdir)) == [
+            'X.npy', 'mask.npy', 'metadata.json', 'params.npy']
+        test_params = np.load(f'{test_outdir}/params.npy')
+        assert test_params.shape == (5, 2)
+        with open(f'{test_outdir}/metadata.json') as fh:
+            metadata = json.load(fh)
+        assert metadata['theta'] == 1000 and metadata['folded']
+        assert metadata['param_names'] == ['nu', 'T']
+
+    finally:  # remove output files
+        for dname in [outdir, test_outdir]:
+            shutil.rmtree(dname, ignore_errors=True)
+        if os.path.isfile(f'{outdir}_quality.txt'):
+            os.remove(f'{outdir}_quality.txt')
+
+
+def test_run_generate_data_store_counts():
+    '''Generate a sampled dataset stored as counts, and a dataset that
+    cannot be stored as counts from the same simulations'''
+
+    outdir = random_string()
+    train_outdir = random_string()
+    try:
+        rv, _ = getstatusoutput(
+            f'{PRG} generate_data --model two_epoch --n_samples 5'
+            f' --sample_sizes 10 --outfile {outdir} --theta 1000'
+            f' --data_format array --store_counts'
+            f' --extra_output {train_outdir} theta=1')
+        assert rv == 0
+        assert np.load(f'{outdir}/X.npy').dtype == np.uint16
+        totals = np.load(f'{outdir}/totals.npy')
+        np.testing.assert_array_equal(
+            totals, np.load(f'{outdir}/X.npy').sum(axis=1))
+        assert np.load(f'{train_outdir}/X.npy').dtype == np.float32
+        assert not os.path.exists(f'{train_outdir}/totals.npy')
+
+    finally:  # remove output files
+        for dname in [outdir, train_outdir]:
+            shutil.rmtree(dname, ignore_errors=True)
+        if os.path.isfile(f'{outdir}_quality.txt'):
+            os.remove(f'{outdir}_quality.txt')
+
+
+def test_run_generate_data_extra_output_bstr_theta_1():
+    '''Test that bootstrapping an extra dataset with theta=1 is rejected'''
+
+    outfile = random_string()
+    test_outfile = random_string()
+    rv, out = getstatusoutput(
+        f'{PRG} generate_data --model two_epoch --n_samples 5'
+        f' --sample_sizes 10 --outfile {outfile} --theta 1000'
+        f' --extra_output {test_outfile} theta=1 bootstrap=true')
+    assert rv != 0
+    assert 'cannot bootstrap --extra_output FS with theta=1' in out
+    assert not os.path.exists(outfile) and not os.path.exists(test_outfile)
+
+
+def test_run_generate_data_n_misid_folded_extra_output():
+    '''Test that --n_misid with a folded extra dataset is rejected'''
+
+    outfile = random_string()
+    test_outfile = random_string()
+    rv, out = getstatusoutput(
+        f'{PRG} generate_data --model two_epoch --n_samples 5'
+        f' --sample_sizes 10 --outfile {outfile} --n_misid 3'
+        f' --extra_output {test_outfile} folded=true')
+    assert rv != 0
+    assert '--n_misid cannot be used with folded --extra_output' in out
+    assert not os.path.exists(outfile) and not os.path.exists(test_outfile)
+
+
+def test_run_generate_data_replace_failed():
+    '''Test that FS whose simulation fails are replaced with FS from
+    newly drawn params'''
+
+    outfile = random_string()
+    model_file = f'{random_string()}.py'
+    with open(model_file, 'w') as fh:
+        fh.write('import dadi\n\n\n'
+                 'def flaky_two_epoch(params, ns, pts):\n'
+                 '    if params[0] < 0.1:\n'
+                 '        raise ValueError("nu < 0.1")\n'
+                 '    return dadi.Demographics1D.two_epoch(params, ns, pts)\n'
+                 '\n\n'
+                 'flaky_two_epoch.__param_names__ = ["nu", "T"]\n')
+    try:
+        rv, _ = getstatusoutput(
+            f'{PRG} generate_data --model flaky_two_epoch'
+            f' --model_file {model_file} --n_samples 20 --sample_sizes 10'
+            f' --seed 1 --outfile {outfile} --replace_failed')
+        assert rv == 0
+        data = pickle.load(open(outfile, 'rb'))
+        assert len(data) == 20
+        assert all(10**p[0] >= 0.1 for p in data)
+        with open(f'{outfile}_quality.txt') as fh:
+            assert 'Number of FS whose simulation failed: 0' not in fh.read()
+
+    finally:  # remove output files
+        for fname in [outfile, model_file, f'{outfile}_quality.txt']:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+
+def test_run_calibrate_grids():
+    '''Calibrate the grids of a model, then generate data with them'''
+
+    profile_dir = random_string()
+    outfile = random_string()
+    try:
+        rv, _ = getstatusoutput(
+            f'{PRG} calibrate_grids --model two_epoch --sample_sizes 10'
+            f' --n_samples 4 --scales 0.75 1 --grid_profile_dir {profile_dir}')
+        assert rv == 0
+        with open(f'{profile_dir}/two_epoch.json') as fh:
+            profile = json.load(fh)
+        assert profile['10']['scale'] in [0.75, 1]
+        rv, _ = getstatusoutput(
+            f'{PRG} generate_data --model two_epoch --n_samples 5'
+            f' --sample_sizes 10 --outfile {outfile}'
+            f' --grid_profile_dir {profile_dir}')
+        assert rv == 0
+        assert len(pickle.load(open(outfile, 'rb'))) == 5
+
+    finally:  # remove output files
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        for fname in [outfile, f'{outfile}_quality.txt']:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+
 # test train subcommand
 def run_train_sub(args):
     """Template method for testing train subcommand"""
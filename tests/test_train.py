@@ -2,6 +2,8 @@
 import os
 import pickle
 from donni.train import *
+from donni.train import _shared_matrix_file, _poisson_augment, _cpu_slots
+from donni.generate_data import save_array_data
 
 
 def test_exists():
@@ -36,3 +38,113 @@ def test_prep_data():
         # correct number of dem params
         for val, key in zip(y[0], list(data.keys())):
             assert len(val) == len(key)
+
+
+def test_train_shared_trunk(tmp_path):
+    """ Test that a shared-trunk MLPR is saved as one model per param """
+
+    data = pickle.load(open('tests/test_data/split_mig_100_subset', 'rb'))
+    X, y = prep_data(data)
+    train(X, y, str(tmp_path), False, shared_trunk=True)
+    fnames = sorted(os.listdir(tmp_path))
+    assert fnames == [f'param_{i+1:02d}_predictor.keras'
+                      for i in range(len(y))]
+    for fname in fnames:
+        mlpr = keras.models.load_model(f'{tmp_path}/{fname}')
+        mean, var = mlpr.predict(X[:3])
+        assert mean.shape == var.shape == (3, 1)
+        assert np.all(var >= 0)
+
+
+def test_shared_matrix_file(tmp_path):
+    """ Test that train workers memory-map the fs matrix from one file """
+
+    data = pickle.load(open('tests/test_data/two_epoch_500', 'rb'))
+    X, _ = prep_data(data)
+    # in-memory matrix is copied once to a file
+    X_fname = _shared_matrix_file(X, str(tmp_path))
+    assert os.path.dirname(X_fname) == str(tmp_path)
+    X_disk = np.load(X_fname, mmap_mode='r')
+    np.testing.assert_array_equal(X_disk, X.astype(np.float32))
+
+    # memory-mapped matrix is used from its own file, but not a view of it
+    assert _shared_matrix_file(X_disk, str(tmp_path / 'other')) == X_fname
+    os.mkdir(tmp_path / 'other')
+    assert _shared_matrix_file(X_disk[:100], str(tmp_path / 'other')) \
+        != X_fname
+    np.testing.assert_array_equal(
+        np.load(str(tmp_path / 'other' / 'X.npy')), X_disk[:100])
+
+
+def test_train_stream(tmp_path):
+    """ Test training from a dataset streamed from disk """
+
+    data = pickle.load(open('tests/test_data/two_epoch_500', 'rb'))
+    save_array_data(data, str(tmp_path / 'data'), {'norm': True})
+    outdir = str(tmp_path / 'mlpr')
+    os.mkdir(outdir)
+    train_stream(str(tmp_path / 'data'), outdir, False, batch_size=64,
+                 shuffle_buffer=100)
+    fnames = sorted(os.listdir(outdir))
+    assert fnames == ['param_01_predictor.keras', 'param_02_predictor.keras']
+    X, _ = prep_data(data)
+    for fname in fnames:
+        mlpr = keras.models.load_model(f'{outdir}/{fname}')
+        mean, var = mlpr.predict(X[:3])
+        assert mean.shape == var.shape == (3, 1)
+
+
+def test_poisson_augment():
+    """ Test that fs are resampled at theta in the given range """
+
+    data = pickle.load(open('tests/test_data/two_epoch_500', 'rb'))
+    X, _ = prep_data(data)
+    X = np.vstack([X[:100], np.zeros(X.shape[1])]).astype(np.float32)
+    X_aug = _poisson_augment(X, (1000, 1000)).numpy()
+    assert X_aug.shape == X.shape
+    np.testing.assert_allclose(X_aug[:100].sum(axis=1), 1, rtol=1e-5)
+    # fs are noisy but close to the model fs at theta=1000
+    assert not np.allclose(X_aug[:100], X[:100])
+    assert np.abs(X_aug[:100] - X[:100]).sum(axis=1).max() < 0.5
+    # a fs without counts is left as zeros
+    assert np.all(X_aug[100] == 0)
+
+    # samples are noisier at lower theta
+    X_low = _poisson_augment(X[:100], (10, 20)).numpy()
+    assert np.abs(X_low - X[:100]).sum() > np.abs(X_aug[:100] - X[:100]).sum()
+
+
+def test_train_augment(tmp_path):
+    """ Test training with Poisson resampled fs """
+
+    data = pickle.load(open('tests/test_data/two_epoch_500', 'rb'))
+    X, y = prep_data(data)
+    train(X, y, str(tmp_path), False, theta_range=(100, 1000))
+    assert sorted(os.listdir(tmp_path)) == ['param_01_predictor.keras',
+                                            'param_02_predictor.keras']
+
+
+def test_cpu_slots():
+    """ Test splitting a CPU budget between train workers """
+
+    n_available = len(os.sched_getaffinity(0))
+    slots = _cpu_slots(13)
+    assert sorted(cpu for cpus in slots for cpu in cpus) == \
+        sorted(os.sched_getaffinity(0))
+    assert len(slots) == min(13, n_available)
+    assert max(map(len, slots)) - min(map(len, slots)) <= 1
+    # fewer CPUs than MLPRs
+    assert [len(cpus) for cpus in _cpu_slots(13, 1)] == [1]
+    # more CPUs than MLPRs
+    if n_available >= 5:
+        assert [len(cpus) for cpus in _cpu_slots(2, 5)] == [3, 2]
+
+
+def test_train_cpu_budget(tmp_path):
+    """ Test that MLPRs are trained one at a time on a budget of 1 CPU """
+
+    data = pickle.load(open('tests/test_data/two_epoch_500', 'rb'))
+    X, y = prep_data(data)
+    cpu_list = train(X, y, str(tmp_path), False, ncpu=1)
+    assert cpu_list == _cpu_slots(2, 1) * 2
+    assert len(os.listdir(tmp_path)) == 2